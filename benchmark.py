@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+""" Measure how the scripts in this collection scale. A synthetic corpus of
+    JPEG photos, short MP4 videos and Samsung Motion Photos is generated with
+    FFmpeg and Exiftool, and each script is run on increasing numbers of files.
+    For every run, the wall time, files per second, number of Exiftool/FFmpeg
+    processes started and peak memory use are reported as JSON, so the results
+    of different versions can be compared. """
+
+import argparse, datetime, json, os, platform, shutil, struct, subprocess, sys, tempfile, time
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The external programs of which the number of started processes is counted
+COUNTED_PROGRAMS = ["exiftool", "ffmpeg", "ffprobe"]
+
+# The datetime of the first photo in the corpus, the next ones are a minute
+# apart
+CORPUS_START = datetime.datetime(2020, 6, 1, 8, 0, 0)
+
+class BenchmarkException(Exception):
+  pass
+
+def run(cmd, **kwargs):
+  """ Run a command for building the corpus, raising a BenchmarkException if it
+      fails. """
+
+  result = subprocess.run(cmd, stdout = subprocess.PIPE, stderr = subprocess.PIPE, **kwargs)
+  if result.returncode != 0:
+    raise BenchmarkException("%s failed: %s" % (cmd[0], result.stderr.decode("utf-8", "replace").strip()))
+  return result
+
+def samsungTrailer(video):
+  """ Build a Samsung trailer with the video as its MotionPhoto_Data block, as
+      found at the end of a Motion Photo. """
+
+  blocks = []
+  for block_type, name, data in ((0x0a30, b"MotionPhoto_Data", video), (0x0a31, b"MotionPhoto_Version", b"mpv2")):
+    blocks.append((block_type, struct.pack("<HHI", 0, block_type, len(name)) + name + data))
+
+  trailer = b"".join(block for _, block in blocks)
+  directory = b"SEFH" + struct.pack("<II", 106, len(blocks))
+  position = 0
+  for block_type, block in blocks:
+    # The entries hold the block type (after two padding bytes, like in the
+    # block header), the distance from the start of the block to the
+    # directory, which directly follows the last block, and the block size
+    directory += struct.pack("<HHII", 0, block_type, len(trailer) - position, len(block))
+    position += len(block)
+  return trailer + directory + struct.pack("<I", len(directory)) + b"SEFT"
+
+class Corpus:
+  """ The synthetic media files, generated on first use in the directory path
+      and reused on later runs. """
+
+  def __init__(self, path):
+    self.path = path
+    os.makedirs(path, exist_ok = True)
+
+  def _base(self, name, cmd):
+    """ Return the path of a base file, creating it with the FFmpeg command
+        (which gets the path appended) if it doesn't exist yet. """
+
+    path = os.path.join(self.path, name)
+    if not os.path.exists(path):
+      run(["ffmpeg", "-y", "-loglevel", "error"] + cmd + [path + ".part" + os.path.splitext(name)[1]])
+      os.replace(path + ".part" + os.path.splitext(name)[1], path)
+    return path
+
+  def baseJPEG(self):
+    return self._base("base.jpg", ["-f", "lavfi", "-i", "testsrc=size=640x480", "-frames:v", "1"])
+
+  def baseVideo(self, seconds):
+    return self._base("base_%ds.mp4" % seconds, ["-f", "lavfi", "-i", "testsrc=size=640x360:rate=25:duration=%d" % seconds,
+                                                  "-f", "lavfi", "-i", "sine=duration=%d" % seconds,
+                                                  "-c:v", "libx264", "-g", "50", "-pix_fmt", "yuv420p", "-c:a", "aac", "-shortest"])
+
+  def photos(self, count):
+    """ Return the paths of count JPEG photos, each with a DateTimeOriginal and
+        CreateDate a minute later than the previous one. """
+
+    directory = os.path.join(self.path, "jpg")
+    os.makedirs(directory, exist_ok = True)
+    paths = [os.path.join(directory, "IMG_%05d.jpg" % i) for i in range(count)]
+    missing = [i for i, path in enumerate(paths) if not os.path.exists(path)]
+    if missing:
+      base = self.baseJPEG()
+      for i in missing:
+        shutil.copyfile(base, paths[i] + ".part")
+
+      # Set the datetimes of all new photos with a single Exiftool process
+      with tempfile.NamedTemporaryFile("w", suffix = ".args", delete = False) as arg_file:
+        for i in missing:
+          stamp = (CORPUS_START + datetime.timedelta(minutes = i)).strftime("%Y:%m:%d %H:%M:%S")
+          arg_file.write("-q\n-overwrite_original\n-DateTimeOriginal=%s\n-CreateDate=%s\n%s\n-execute\n" %
+                         (stamp, stamp, paths[i] + ".part"))
+      try:
+        run(["exiftool", "-@", arg_file.name])
+      finally:
+        os.remove(arg_file.name)
+      for i in missing:
+        os.replace(paths[i] + ".part", paths[i])
+    return paths
+
+  def motionPhotos(self, count):
+    """ Return the paths of count Samsung Motion Photos, each a JPEG photo with
+        a short video in a Samsung trailer. """
+
+    directory = os.path.join(self.path, "motion")
+    os.makedirs(directory, exist_ok = True)
+    paths = [os.path.join(directory, "MP_%05d.jpg" % i) for i in range(count)]
+    if not all(os.path.exists(path) for path in paths):
+      with open(self.baseJPEG(), "rb") as in_file:
+        photo = in_file.read()
+      with open(self.baseVideo(3), "rb") as in_file:
+        content = photo + samsungTrailer(in_file.read())
+      for path in paths:
+        if not os.path.exists(path):
+          with open(path + ".part", "wb") as out_file:
+            out_file.write(content)
+          os.replace(path + ".part", path)
+    return paths
+
+  def metadataFixtures(self):
+    """ Return a list of (path, supported) tuples of JPEG, MP4 and MOV files for
+        checking nativemetadata.py against Exiftool. supported tells if the
+        datetime tags of the file should be read natively; for the others,
+        nativemetadata.py should fall back to Exiftool. """
+
+    directory = os.path.join(self.path, "metadata")
+    os.makedirs(directory, exist_ok = True)
+    stamp = "2021:03:04 05:06:07"
+    creation_time = ["-metadata", "creation_time=2021-03-04T05:06:07Z"]
+
+    # The name, how to make it from the base files, the Exiftool arguments to
+    # apply afterwards and if it should be supported
+    fixtures = [
+      ("both.jpg",         None,          ["-DateTimeOriginal=" + stamp, "-CreateDate=" + stamp], True),
+      ("no_dates.jpg",     None,          [], False),
+      ("dto_only.jpg",     None,          ["-DateTimeOriginal=" + stamp], False),
+      ("createdate_only.jpg", None,       ["-CreateDate=" + stamp], False),
+      ("xmp_only.jpg",     None,          ["-XMP-exif:DateTimeOriginal=" + stamp, "-XMP-xmp:CreateDate=" + stamp], False),
+      ("dated.mp4",        creation_time, [], True),
+      ("dated.mov",        creation_time, [], True),
+      ("undated.mp4",      [],            [], False),
+      ("xmp.mp4",          creation_time, ["-XMP-xmp:CreateDate=" + stamp], False),
+      ("heic_brand.mp4",   creation_time, [], False),
+      ("unknown_box.mp4",  creation_time, [], False),
+    ]
+
+    paths = [(os.path.join(directory, name), supported) for name, _, _, supported in fixtures]
+    if all(os.path.exists(path) for path, _ in paths):
+      return paths
+
+    arg_lines = []
+    for name, ffmpeg_args, exiftool_args, _ in fixtures:
+      path = os.path.join(directory, name)
+      part = path + ".part" + os.path.splitext(name)[1]
+      if ffmpeg_args is None:
+        shutil.copyfile(self.baseJPEG(), part)
+      else:
+        run(["ffmpeg", "-y", "-loglevel", "error", "-i", self.baseVideo(1), "-c", "copy"] + ffmpeg_args + [part])
+      if exiftool_args:
+        arg_lines += ["-q", "-overwrite_original"] + exiftool_args + [part, "-execute"]
+
+    with tempfile.NamedTemporaryFile("w", suffix = ".args", delete = False) as arg_file:
+      arg_file.write("\n".join(arg_lines) + "\n")
+    try:
+      run(["exiftool", "-@", arg_file.name])
+    finally:
+      os.remove(arg_file.name)
+
+    # Make files that are plain movies apart from a HEIF brand, or an extra box
+    # that nativemetadata.py doesn't know
+    with open(os.path.join(directory, "heic_brand.mp4.part.mp4"), "r+b") as out_file:
+      out_file.seek(8)
+      out_file.write(b"heic")
+    with open(os.path.join(directory, "unknown_box.mp4.part.mp4"), "ab") as out_file:
+      out_file.write(struct.pack(">I4s", 16, b"abcd") + bytes(8))
+
+    for name, _, _, _ in fixtures:
+      path = os.path.join(directory, name)
+      os.replace(path + ".part" + os.path.splitext(name)[1], path)
+    return paths
+
+class Runner:
+  """ Runs the scripts with the counted programs replaced by wrappers that log
+      each start, and measures them. """
+
+  def __init__(self, work_dir):
+    self.work_dir = work_dir
+    self.shim_dir = os.path.join(work_dir, "shims")
+    self.spawn_log = os.path.join(work_dir, "spawns.log")
+
+    os.makedirs(self.shim_dir, exist_ok = True)
+    for program in COUNTED_PROGRAMS:
+      real = shutil.which(program)
+      if not real:
+        continue
+      shim = os.path.join(self.shim_dir, program)
+      with open(shim, "w") as out_file:
+        out_file.write("#!/bin/sh\necho %s >> \"$BENCHMARK_SPAWN_LOG\"\nexec '%s' \"$@\"\n" % (program, real))
+      os.chmod(shim, 0o755)
+
+  def measure(self, cmd, files, cwd = None, env = None):
+    """ Run the command and return a dict with its wall time, the number of
+        files per second, the number of started processes of each counted
+        program and the peak resident memory of the command and the processes
+        it waited for. """
+
+    if os.path.exists(self.spawn_log):
+      os.remove(self.spawn_log)
+    run_env = dict(os.environ)
+    run_env.update(env or {})
+    run_env["PATH"] = self.shim_dir + os.pathsep + run_env.get("PATH", "")
+    run_env["BENCHMARK_SPAWN_LOG"] = self.spawn_log
+
+    with open(os.path.join(self.work_dir, "last_run.log"), "wb") as log_file:
+      start = time.perf_counter()
+      process = subprocess.Popen(cmd, cwd = cwd, env = run_env, stdin = subprocess.DEVNULL,
+                                 stdout = log_file, stderr = subprocess.STDOUT)
+      # wait4() gives the resource usage of the process and its children
+      _, status, usage = os.wait4(process.pid, 0)
+      wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    spawns = dict.fromkeys(COUNTED_PROGRAMS, 0)
+    if os.path.exists(self.spawn_log):
+      with open(self.spawn_log, "r") as in_file:
+        for line in in_file:
+          if line.strip() in spawns:
+            spawns[line.strip()] += 1
+    spawns["total"] = sum(spawns.values())
+
+    return {"returncode": process.returncode,
+            "wall_s": round(wall, 3),
+            "files_per_s": round(files / wall, 2) if wall > 0 else None,
+            "subprocesses": spawns,
+            "peak_rss_kb": usage.ru_maxrss}
+
+def scratchCopy(paths, directory):
+  """ Copy the files to an empty scratch directory, since the scripts modify
+      them. Returns the paths of the copies. """
+
+  if os.path.exists(directory):
+    shutil.rmtree(directory)
+  os.makedirs(directory)
+  copies = []
+  for path in paths:
+    copy = os.path.join(directory, os.path.basename(path))
+    shutil.copyfile(path, copy)
+    copies.append(copy)
+  return copies
+
+def benchCorrectPhotoDrift(corpus, runner, sizes, jobs):
+  """ Read and correct the datetime of the photos, in the default and in the
+      grouped shift mode. The metadata cache is disabled, so every run reads all
+      photos. """
+
+  csv_file = os.path.join(runner.work_dir, "drift.csv")
+  with open(csv_file, "w") as out_file:
+    # A clock that runs 10 seconds per hour slow
+    for hours in (0, 1000):
+      exif = CORPUS_START + datetime.timedelta(hours = hours)
+      real = exif + datetime.timedelta(seconds = 300 + 10 * hours)
+      out_file.write("%s,%s\n" % (exif.strftime("%Y-%m-%d %H:%M:%S"), real.strftime("%Y-%m-%d %H:%M:%S")))
+
+  script = os.path.join(SCRIPT_DIR, "correctphotodrift.py")
+  for size in sizes:
+    photos = corpus.photos(size)
+    for case, options in (("dry-run", ["-n"]), ("correct", []), ("group-shifts", ["-g"])):
+      scratch = scratchCopy(photos, os.path.join(runner.work_dir, "scratch"))
+      result = runner.measure([sys.executable, script, "--no-cache", "-o", "-j", str(jobs)] + options + [csv_file] + scratch, size)
+      yield dict({"script": "correctphotodrift.py", "case": case, "files": size}, **result)
+
+def benchExtractMotionPhoto(corpus, runner, sizes, jobs):
+  """ Extract the videos from a directory of Motion Photos. """
+
+  script = os.path.join(SCRIPT_DIR, "extractmotionphoto.py")
+  for size in sizes:
+    scratch_dir = os.path.join(runner.work_dir, "scratch")
+    scratchCopy(corpus.motionPhotos(size), scratch_dir)
+    result = runner.measure([sys.executable, script, "-j", str(jobs), scratch_dir], size)
+    yield dict({"script": "extractmotionphoto.py", "case": "extract", "files": size}, **result)
+
+def benchGrabFrame(corpus, runner, frame_counts):
+  """ Grab increasing numbers of frames, spread evenly over a video. """
+
+  script = os.path.join(SCRIPT_DIR, "grabframe.py")
+  seconds = 60
+  for count in frame_counts:
+    video = scratchCopy([corpus.baseVideo(seconds)], os.path.join(runner.work_dir, "scratch"))[0]
+    stamps = ["%.3f" % (seconds * (i + 0.5) / count) for i in range(count)]
+    result = runner.measure([sys.executable, script, video] + stamps, count)
+    yield dict({"script": "grabframe.py", "case": "time stamps", "files": count}, **result)
+
+def benchStabilizeVideo(corpus, runner, jobs):
+  """ Stabilize a short video, with an empty and with a filled .trf cache. """
+
+  filters = run(["ffmpeg", "-hide_banner", "-filters"]).stdout.decode("utf-8", "replace")
+  if "vidstabdetect" not in filters:
+    sys.stderr.write("Skipping stabilizevideo.sh, FFmpeg doesn't have the vidstab filters\n")
+    return
+
+  script = os.path.join(SCRIPT_DIR, "stabilizevideo.sh")
+  cache_dir = os.path.join(runner.work_dir, "trf_cache")
+  if os.path.exists(cache_dir):
+    shutil.rmtree(cache_dir)
+  for case in ("cold cache", "warm cache"):
+    video = scratchCopy([corpus.baseVideo(10)], os.path.join(runner.work_dir, "scratch"))[0]
+    result = runner.measure(["bash", script, "-t", str(jobs), video], 1, env = {"XDG_CACHE_HOME": cache_dir})
+    yield dict({"script": "stabilizevideo.sh", "case": case, "files": 1}, **result)
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description = "Benchmark the scripts on a synthetic corpus of photos and videos, and print the results as JSON.")
+  parser.add_argument("-s", "--sizes", type = str, default = "100,1000,10000",
+                      help = "Comma separated numbers of files to run the batch scripts on (defaults to 100,1000,10000).")
+  parser.add_argument("-f", "--frames", type = str, default = "10,100",
+                      help = "Comma separated numbers of frames to grab from a video (defaults to 10,100).")
+  parser.add_argument("-j", "--jobs", type = int, default = os.cpu_count() or 1,
+                      help = "The number of jobs to pass to the scripts that support it (defaults to the number of processors).")
+  parser.add_argument("-w", "--work-dir", type = str, default = os.path.join(tempfile.gettempdir(), "photoandvideoscripts-benchmark"),
+                      help = "The directory for the corpus and the scratch files. The corpus is kept for the next run.")
+  parser.add_argument("-o", "--output", type = str,
+                      help = "Write the JSON results to this file instead of to standard output.")
+  parser.add_argument("script", type = str, nargs = "*",
+                      help = "The scripts to benchmark, out of correctphotodrift, extractmotionphoto, grabframe and stabilizevideo (defaults to all of them).")
+  args = parser.parse_args()
+
+  try:
+    sizes = [int(size) for size in args.sizes.split(",")]
+    frame_counts = [int(count) for count in args.frames.split(",")]
+  except ValueError:
+    parser.error("The sizes and frame counts should be comma separated numbers")
+  if args.jobs < 1:
+    parser.error("The number of jobs should be at least 1")
+  scripts = args.script or ["correctphotodrift", "extractmotionphoto", "grabframe", "stabilizevideo"]
+  for script in scripts:
+    if script not in ("correctphotodrift", "extractmotionphoto", "grabframe", "stabilizevideo"):
+      parser.error("Unknown script '%s'" % script)
+
+  for program in ("ffmpeg", "exiftool"):
+    if not shutil.which(program):
+      sys.stderr.write("Please install %s\n" % program)
+      sys.exit(1)
+
+  corpus = Corpus(os.path.join(args.work_dir, "corpus"))
+  runner = Runner(args.work_dir)
+
+  results = []
+  benchmarks = {"correctphotodrift":  lambda: benchCorrectPhotoDrift(corpus, runner, sizes, args.jobs),
+                "extractmotionphoto": lambda: benchExtractMotionPhoto(corpus, runner, sizes, args.jobs),
+                "grabframe":          lambda: benchGrabFrame(corpus, runner, frame_counts),
+                "stabilizevideo":     lambda: benchStabilizeVideo(corpus, runner, args.jobs)}
+  try:
+    for script in scripts:
+      for result in benchmarks[script]():
+        sys.stderr.write("%s (%s, %d files): %.2f s, %d processes\n" %
+                         (result["script"], result["case"], result["files"], result["wall_s"], result["subprocesses"]["total"]))
+        results.append(result)
+  except BenchmarkException as e:
+    sys.stderr.write("Couldn't build the corpus: %s\n" % e)
+    sys.exit(1)
+  finally:
+    scratch_dir = os.path.join(args.work_dir, "scratch")
+    if os.path.exists(scratch_dir):
+      shutil.rmtree(scratch_dir)
+
+  report = {"date": datetime.datetime.now().isoformat(timespec = "seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "jobs": args.jobs,
+            "results": results}
+  if args.output:
+    with open(args.output, "w") as out_file:
+      json.dump(report, out_file, indent = 2)
+  else:
+    print(json.dumps(report, indent = 2))
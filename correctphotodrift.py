@@ -1,16 +1,354 @@
 #!/usr/bin/env python3
 
-import argparse, datetime, os.path, re, subprocess, sys
+import argparse, bisect, collections, concurrent.futures, datetime, itertools, json, os.path, queue, selectors, sqlite3, subprocess, sys, threading, time
+
+import instrument, nativemetadata
 
 DATE_FORMAT = "%Y-%m-%d"
 TIME_FORMAT = "%H:%M:%S"
 DT_FORMAT   = "%s %s" % (DATE_FORMAT, TIME_FORMAT)
 
+# The extensions of the photos and videos that are used as clock photos in a
+# pairs directory, in order of preference when there are several files with
+# the same name (like a RAW file and a JPEG of the same shot)
+CLOCK_PHOTO_EXTENSIONS = [".jpg", ".jpeg", ".heic", ".png", ".tif", ".tiff", ".dng", ".cr2", ".cr3", ".nef", ".arw",
+                          ".orf", ".rw2", ".raf", ".mp4", ".mov", ".m4v", ".3gp"]
+
+class ExifTool:
+  """ A long-lived Exiftool process running in -stay_open mode. Commands are
+      fed to it through stdin, so the Perl interpreter only needs to start up
+      once instead of once for every file. """
+
+  def __init__(self):
+    self._process = subprocess.Popen(["exiftool", "-stay_open", "True", "-@", "-"],
+                                     stdin = subprocess.PIPE,
+                                     stdout = subprocess.PIPE,
+                                     stderr = subprocess.PIPE)
+    self._seq = 0
+
+  def execute(self, args):
+    """ Run a single Exiftool command with the given list of arguments (without
+        the "exiftool" program name). Returns a subprocess.CompletedProcess
+        with the binary stdout and stderr of the command. Since Exiftool
+        doesn't report an exit status in -stay_open mode, the return code is
+        set to 1 if an error was reported on stderr. """
+
+    self._seq += 1
+    ready = b"{ready%d}\n" % self._seq
+
+    # Each argument goes on its own line. The -echo4 option prints the ready
+    # marker to stderr as well, so we know when both streams are complete.
+    lines = list(args) + ["-echo4", "{ready%d}" % self._seq, "-execute%d" % self._seq]
+    for line in lines:
+      if "\n" in line:
+        raise Exception("Exiftool arguments can't contain newlines: %s" % line)
+    command = ("\n".join(lines) + "\n").encode("utf-8")
+    with instrument.span("exiftool -stay_open", "exiftool", args = len(args)) as timed:
+      self._process.stdin.write(command)
+      self._process.stdin.flush()
+
+      # Read stdout and stderr simultaneously, until both end with the ready
+      # marker. Reading them one after the other could deadlock when Exiftool
+      # fills up the pipe of the other one.
+      output = {self._process.stdout: b"", self._process.stderr: b""}
+      with selectors.DefaultSelector() as selector:
+        for stream in output:
+          selector.register(stream, selectors.EVENT_READ)
+        while selector.get_map():
+          for key, _ in selector.select():
+            data = os.read(key.fd, 65536)
+            if not data:
+              raise Exception("Exiftool exited unexpectedly")
+            output[key.fileobj] += data
+            if output[key.fileobj].endswith(ready):
+              selector.unregister(key.fileobj)
+      timed.bytes_out = len(command)
+      timed.bytes_in  = sum(len(data) for data in output.values())
+
+    stdout = output[self._process.stdout][:-len(ready)]
+    stderr = output[self._process.stderr][:-len(ready)]
+    returncode = 0
+    for line in stderr.splitlines():
+      if line.startswith(b"Error"):
+        returncode = 1
+    return subprocess.CompletedProcess(["exiftool"] + list(args), returncode, stdout, stderr)
+
+  def close(self):
+    """ Tell Exiftool to quit and wait for it. """
+
+    try:
+      self._process.stdin.write(b"-stay_open\nFalse\n")
+      self._process.stdin.close()
+    except OSError:
+      pass
+    self._process.wait()
+    self._process.stdout.close()
+    self._process.stderr.close()
+
+class ExifToolPool:
+  """ A pool of at most size ExifTool workers. Workers are started on demand,
+      so a single-threaded user only ever starts one Exiftool process. The pool
+      can be shared between threads. """
+
+  def __init__(self, size = 1):
+    self._size    = size
+    self._workers = []
+    self._idle    = queue.Queue()
+    self._lock    = threading.Lock()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def _acquire(self):
+    while True:
+      try:
+        worker = self._idle.get_nowait()
+      except queue.Empty:
+        with self._lock:
+          if len(self._workers) < self._size:
+            try:
+              worker = ExifTool()
+            except Exception:
+              # Let the next waiting thread try to start a worker as well
+              self._idle.put(None)
+              raise
+            self._workers.append(worker)
+            return worker
+        worker = self._idle.get()
+
+      # None is put on the queue when a worker is dropped, so a waiting thread
+      # wakes up and starts a replacement
+      if worker is not None:
+        return worker
+
+  def run(self, args):
+    """ Run an Exiftool command on a free worker. See ExifTool.execute(). """
+
+    with instrument.span("wait for worker", "exiftool"):
+      worker = self._acquire()
+    try:
+      result = worker.execute(args)
+    except Exception:
+      # Don't hand out a worker that is in an unknown state
+      with self._lock:
+        self._workers.remove(worker)
+      self._idle.put(None)
+      worker.close()
+      raise
+    self._idle.put(worker)
+    return result
+
+  def close(self):
+    with self._lock:
+      for worker in self._workers:
+        worker.close()
+      self._workers = []
+
+def runExiftool(args, pool = None):
+  """ Run Exiftool with the given list of arguments, either through the
+      ExifToolPool pool or as a separate process if pool is None. Returns a
+      subprocess.CompletedProcess with the binary stdout and stderr. """
+
+  if pool:
+    return pool.run(args)
+  return subprocess.run(["exiftool"] + list(args), stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+
+class MetaDataCache:
+  """ On-disk cache of the known datetime tag values of files, stored in an
+      SQLite database. Entries are keyed by the absolute path, size and
+      modification time of the file, so the values are read again when the
+      file changes. The cache can be shared between threads, and between
+      scripts running at the same time. It's only an optimization: if the
+      database can't be used (for example because another run keeps it locked
+      for too long), a warning is shown and the cache is disabled. """
+
+  # How many entries or seconds to collect in a single write transaction. The
+  # database is locked for other processes while it's open, so keep it short.
+  COMMIT_ENTRIES = 500
+  COMMIT_SECONDS = 1.0
+
+  def __init__(self, path = None):
+    """ Open the cache database at path, or at the default location in the XDG
+        cache directory if path is None. """
+
+    if not path:
+      cache_dir = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+      path = os.path.join(cache_dir, "photoandvideoscripts", "metadata.sqlite")
+    if os.path.dirname(path):
+      os.makedirs(os.path.dirname(path), exist_ok = True)
+
+    self._lock       = threading.Lock()
+    self._pending    = 0
+    self._first_put  = None
+    self._disabled   = False
+    self._connection = sqlite3.connect(path, timeout = 2, check_same_thread = False)
+
+    # With a write-ahead log, readers don't have to wait for a writer
+    self._connection.execute("PRAGMA journal_mode=WAL")
+    self._connection.execute("""CREATE TABLE IF NOT EXISTS metadata (
+                                  path       TEXT PRIMARY KEY,
+                                  size       INTEGER,
+                                  mtime_ns   INTEGER,
+                                  tag_values TEXT)""")
+    self._connection.commit()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+  def _disable(self, error):
+    """ Stop using the cache after the sqlite3.Error error. Must be called with
+        the lock held. """
+
+    if not self._disabled:
+      sys.stderr.write("Not using the metadata cache anymore: %s\n" % error)
+      self._disabled = True
+      try:
+        self._connection.rollback()
+      except sqlite3.Error:
+        pass
+
+  def _written(self):
+    """ Count a changed entry, and commit when the transaction has been open
+        long enough. Must be called with the lock held. """
+
+    self._pending += 1
+    if self._first_put is None:
+      self._first_put = time.monotonic()
+    if self._pending >= self.COMMIT_ENTRIES or time.monotonic() - self._first_put >= self.COMMIT_SECONDS:
+      self._commit()
+
+  def _commit(self):
+    self._connection.commit()
+    self._pending   = 0
+    self._first_put = None
+
+  def get(self, path):
+    """ Return the dict of tag values for the file at path, or None if it isn't
+        in the cache or the file has changed. """
+
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return None
+
+    with self._lock, instrument.span("cache get", "cache"):
+      if self._disabled:
+        return None
+      try:
+        row = self._connection.execute("SELECT size, mtime_ns, tag_values FROM metadata WHERE path = ?",
+                                       (os.path.abspath(path),)).fetchone()
+      except sqlite3.Error as e:
+        self._disable(e)
+        return None
+    if row and row[0] == stat.st_size and row[1] == stat.st_mtime_ns:
+      return json.loads(row[2])
+    return None
+
+  def put(self, path, tag_values):
+    """ Store the dict of tag values for the file at path, as it is now. """
+
+    try:
+      stat = os.stat(path)
+    except OSError:
+      return
+
+    with self._lock, instrument.span("cache put", "cache"):
+      if self._disabled:
+        return
+      try:
+        self._connection.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)",
+                                 (os.path.abspath(path), stat.st_size, stat.st_mtime_ns, json.dumps(tag_values)))
+        self._written()
+      except sqlite3.Error as e:
+        self._disable(e)
+
+  def invalidate(self, path):
+    """ Remove the entry for the file at path. """
+
+    with self._lock:
+      if self._disabled:
+        return
+      try:
+        self._connection.execute("DELETE FROM metadata WHERE path = ?", (os.path.abspath(path),))
+        self._written()
+      except sqlite3.Error as e:
+        self._disable(e)
+
+  def commit(self):
+    """ Write the pending changes to the database. """
+
+    with self._lock:
+      if self._disabled or not self._pending:
+        return
+      try:
+        self._commit()
+      except sqlite3.Error as e:
+        self._disable(e)
+
+  def close(self):
+    self.commit()
+    with self._lock:
+      self._connection.close()
+
 class TimePoint:
   def __init__(self, exif, real):
     self.exif = exif
     self.real = real
 
+class DriftModel:
+  """ The piecewise-linear mapping from exif time to real time described by a
+      list of TimePoints, sorted by exif time (as returned by readCSVFile()).
+      The slope and offset of each segment are calculated once, and the
+      segment for a timestamp is found by bisection. Timestamps before or
+      after the reference points are extrapolated from the two nearest
+      points. """
+
+  def __init__(self, reference_points):
+    if len(reference_points) < 2:
+      raise Exception("At least two reference points are needed")
+
+    self._exif = [point.exif for point in reference_points]
+
+    # The (slope, offset) of each segment between two consecutive points, or
+    # None if both points have the same exif time
+    self._segments = []
+    for start, end in zip(reference_points, reference_points[1:]):
+      if end.exif == start.exif:
+        self._segments.append(None)
+      else:
+        slope  = (end.real - start.real) / (end.exif - start.exif)
+        offset = start.real - start.exif * slope
+        self._segments.append((slope, offset))
+
+  def correct(self, exif_stamp):
+    """ Return the real timestamp for exif_stamp, rounded to whole seconds. """
+
+    # Use the first or last segment for points outside of the range, otherwise
+    # the segment that starts at the last point before or at the stamp
+    if exif_stamp <= self._exif[0]:
+      segment = self._segments[0]
+    elif exif_stamp >= self._exif[-1]:
+      segment = self._segments[-1]
+    else:
+      segment = self._segments[bisect.bisect_right(self._exif, exif_stamp) - 1]
+
+    if not segment:
+      raise Exception("Reference points with the same exif time can't be used for extrapolation")
+
+    slope, offset = segment
+    return round(exif_stamp * slope + offset)
+
+  def correctAll(self, exif_stamps):
+    """ Return the list of real timestamps for the list of exif_stamps. """
+
+    return [self.correct(stamp) for stamp in exif_stamps]
+
 class MetaDataDateTime:
   known_tags = [
     "DateTimeOriginal",
@@ -20,48 +358,88 @@ class MetaDataDateTime:
     "TrackCreateDate",
     "TrackModifyDate"]
 
-  def __init__(self, path, ignore_read_tags = []):
+  # Read the tags of common JPEG and MP4/MOV files without Exiftool
+  use_native_reader = True
+
+  def __init__(self, path, ignore_read_tags = [], pool = None, tag_values = None, cache = None):
+    """ Read the datetime metadata of the file at path. If tag_values is given,
+        it should be a dict with the values of the known_tags that are
+        present (as read by readMetaDataBatch()), and the file isn't read
+        again. Otherwise the values are taken from the MetaDataCache cache,
+        if given and up to date, unless the native reader is disabled. """
     self._path = path
+
+    # The ExifToolPool to run Exiftool through, or None to start a new
+    # Exiftool process for each operation
+    self._pool = pool
+
+    # The MetaDataCache to keep up to date, if any
+    self._cache = cache
     
     # The list of datetime related tags that we have in the metadata
     self._tags = []
 
     # The DateTime of the image and the tag where it came from
-    self.dt, self.dt_tag = self._readMetaData(ignore_read_tags)
+    if tag_values is None and cache and self.use_native_reader:
+      tag_values = cache.get(path)
+    if tag_values is None:
+      tag_values = self._readMetaData()
+      if cache:
+        cache.put(path, tag_values)
+    self.dt, self.dt_tag = self._parseTagValues(tag_values, ignore_read_tags)
+
+    # The values of all known tags that are present, formatted as DT_FORMAT
+    self.tag_values = tag_values
 
-    # The corrected datetime of the image. This can be determined using the
-    # calcCorrection() method
+    # The corrected datetime of the image and the number of seconds it is
+    # shifted by. These can be determined using the calcCorrection() method
     self._corrected_dt = None
+    self._shift        = None
+
+  def _readMetaData(self):
+    """ Read the relevant metadata from the image file. It returns a dict with
+        the values of the known tags that are present in the file. """
 
-  def _readMetaData(self, ignore_read_tags):
-    """ Read the relevant metadata from the image file. It returns the DateTime
-        object of the image and the name of the tag that was used for
-        deterimining it. """
+    tag_values = _readNativeTagValues(self._path)
+    if tag_values is not None:
+      return tag_values
 
     # Construct the command arguments
-    cmd = ["exiftool", "-veryShort", "-d", DT_FORMAT]
+    cmd = ["-veryShort", "-d", DT_FORMAT]
     for tag in self.known_tags: # Add every possible date tag
       cmd.append("-%s" % tag)
     cmd.append(self._path)
 
     # Run exiftool
-    result = subprocess.run(cmd, stdout = subprocess.PIPE)
+    result = runExiftool(cmd, self._pool)
     if result.returncode != 0:
       raise Exception("Exiftool failed on %s" % self._path)
     stdout = result.stdout.decode("utf-8")
-    
-    # Analyze the result
+
+    # Each line is formatted as "Tag: value"
+    tag_values = {}
+    for line in stdout.splitlines():
+      tag, _, value = line.partition(":")
+      if tag in self.known_tags and tag not in tag_values:
+        tag_values[tag] = value.strip()
+
+    return tag_values
+
+  def _parseTagValues(self, tag_values, ignore_read_tags):
+    """ Determine the DateTime of the image from the dict of tag values. It
+        returns the DateTime object of the image and the name of the tag that
+        was used for deterimining it. """
+
     dt       = None
     used_tag = None
     for tag in self.known_tags:
-      match = re.search("^%s:\s+(.*)\s*" % tag, stdout, re.MULTILINE)
-      if match:
+      if tag in tag_values:
         self._tags.append(tag)
         
         # Extract the datetime if we don't have it yet
         if not dt and tag not in ignore_read_tags:
           used_tag = tag
-          dt = datetime.datetime.strptime(match.group(1), DT_FORMAT)
+          dt = datetime.datetime.strptime(tag_values[tag], DT_FORMAT)
     
     if not dt:
       raise Exception("Couldn't read date and time information from %s" % self._path)
@@ -69,60 +447,228 @@ class MetaDataDateTime:
     return dt, used_tag
     
   def calcCorrection(self, reference_points):
-    """ Calculate the corrected datetime based on the list of reference points.
-        This method sets the self._corrected_dt field and return the offset in
-        seconds. """
+    """ Calculate the corrected datetime based on the list of reference points
+        or a DriftModel built from it. This method sets the self._corrected_dt
+        field and return the offset in seconds. """
 
-    original_dt_stamp = self.dt.timestamp()
-    
-    # Find two points to use for interpolation. If the timestamp lies before or
-    # after the range, use the two nearest points.
-    if original_dt_stamp <= reference_points[0].exif:
-      start = reference_points[0]
-      end   = reference_points[1]
-    elif original_dt_stamp >= reference_points[-1].exif:
-      start = reference_points[-2]
-      end   = reference_points[-1]
-    else:
-      for i in range(len(reference_points) - 1):
-        if original_dt_stamp >= reference_points[i].exif and \
-           original_dt_stamp < reference_points[i + 1].exif:
-          start = reference_points[i]
-          end   = reference_points[i + 1]
-          break
-    
-    # Find the slope and offset to map an exif time on real time
-    slope  = (end.real - start.real) / (end.exif - start.exif)
-    offset = start.real - start.exif * slope
-    
-    # Use these values to calculate the correct time
-    corrected_dt_stamp = round(original_dt_stamp * slope + offset)
-    
-    self._corrected_dt = datetime.datetime.fromtimestamp(corrected_dt_stamp)    
+    if not isinstance(reference_points, DriftModel):
+      reference_points = DriftModel(reference_points)
+
+    return self.setCorrection(reference_points.correct(self.dt.timestamp()))
+
+  def setCorrection(self, corrected_dt_stamp):
+    """ Set the corrected datetime to the timestamp corrected_dt_stamp, as
+        calculated with a DriftModel. Like calcCorrection(), this sets the
+        self._corrected_dt field and returns the offset in seconds. """
+
+    original_dt_stamp  = self.dt.timestamp()
+    self._corrected_dt = datetime.datetime.fromtimestamp(corrected_dt_stamp)
+    self._shift        = round(corrected_dt_stamp - original_dt_stamp)
     return corrected_dt_stamp - original_dt_stamp
     
-  def writeMetaData(self):
+  def writeMetaData(self, overwrite_original = False):
     """ Write the corrected datetime to the metadata. Return True on success,
-        False on failure.
+        False on failure. If overwrite_original is True, Exiftool doesn't keep
+        a copy of the original file.
         NOTE: you need to run calcCorrection() first. """
         
     if not self._corrected_dt:
       raise Exception("You need to run the calcCorrection() method first!")
 
     # Construct the Exiftool command by setting all known tags to the new stamp
-    cmd = ["exiftool", "-d", DT_FORMAT]
+    cmd = ["-d", DT_FORMAT]
+    if overwrite_original:
+      cmd.append("-overwrite_original")
     dt_str = self._corrected_dt.strftime(DT_FORMAT)
     for tag in self._tags:
       cmd.append("-%s=%s" % (tag, dt_str))
     cmd.append(self._path)
 
     # Run Exiftool
-    result = subprocess.run(cmd, stdout = subprocess.PIPE)
+    result = runExiftool(cmd, self._pool)
     if result.returncode == 0:
+      if self._cache:
+        self._cache.put(self._path, {tag: dt_str for tag in self._tags})
       return True
     
+    if self._cache:
+      self._cache.invalidate(self._path)
     return False
   
+def _readNativeTagValues(path):
+  """ Read the known tags of the file at path with the nativemetadata module, if
+      enabled. Returns a dict of the tag values formatted as DT_FORMAT, or None
+      if Exiftool should be used. """
+
+  if not MetaDataDateTime.use_native_reader:
+    return None
+
+  # Whatever goes wrong, Exiftool can still have a look at the file
+  with instrument.span("read native", "io"):
+    try:
+      tags = nativemetadata.readDateTimeTags(path)
+    except Exception:
+      tags = None
+  if tags is None:
+    return None
+  return {tag: tags[tag].strftime(DT_FORMAT) for tag in MetaDataDateTime.known_tags if tag in tags}
+
+def failedPaths(result, paths):
+  """ Return the set of the paths that the Exiftool command with the
+      subprocess.CompletedProcess result, run on the list of paths, couldn't
+      write. """
+
+  # Exiftool reports failures as "Error: message - file". If it failed
+  # without telling us for which file, consider all files failed.
+  failed = set()
+  for line in result.stderr.decode("utf-8", "replace").splitlines():
+    if line.startswith("Error"):
+      for path in paths:
+        if line.endswith(" - %s" % path):
+          failed.add(path)
+  if result.returncode != 0 and not failed:
+    failed = set(paths)
+  return failed
+
+def shiftMetaDataBatch(metadatas, pool = None, overwrite_original = False, chunk_size = 500, cache = None):
+  """ Write the corrections of a list of MetaDataDateTime objects by shifting
+      their datetime tags relative to the current values, rather than setting
+      them to the corrected datetime like writeMetaData() does. Files with the
+      same shift and tags are written with a single Exiftool command for each
+      chunk of chunk_size files. If overwrite_original is True, Exiftool
+      doesn't keep a copy of the original files. The MetaDataCache cache is
+      updated with the new values, if given.
+      Returns the set of paths that couldn't be written.
+      NOTE: you need to run calcCorrection() on each object first. """
+
+  groups = collections.defaultdict(list)
+  for metadata in metadatas:
+    if metadata._shift is None:
+      raise Exception("You need to run the calcCorrection() method first!")
+    groups[(metadata._shift, tuple(metadata._tags))].append(metadata)
+
+  failed = set()
+  for (shift, tags), group in groups.items():
+    # There's nothing to write if the time is already correct
+    if shift == 0:
+      continue
+    paths = [metadata._path for metadata in group]
+
+    hours, seconds = divmod(abs(shift), 60 * 60)
+    minutes, seconds = divmod(seconds, 60)
+    operator = "+=" if shift > 0 else "-="
+
+    for start in range(0, len(paths), chunk_size):
+      chunk = paths[start:start + chunk_size]
+
+      cmd = ["-overwrite_original"] if overwrite_original else []
+      for tag in tags:
+        cmd.append("-%s%s%d:%02d:%02d" % (tag, operator, hours, minutes, seconds))
+      cmd += chunk
+
+      failed |= failedPaths(runExiftool(cmd, pool), chunk)
+
+    if cache:
+      for metadata in group:
+        if metadata._path in failed:
+          cache.invalidate(metadata._path)
+          continue
+        try:
+          cache.put(metadata._path, {tag: (datetime.datetime.strptime(value, DT_FORMAT) +
+                                           datetime.timedelta(seconds = shift)).strftime(DT_FORMAT)
+                                     for tag, value in metadata.tag_values.items()})
+        except ValueError:
+          cache.invalidate(metadata._path)
+      cache.commit()
+
+  return failed
+
+def _readJSONEntries(paths, pool = None):
+  """ Read the known tags of the files in the paths list with a single Exiftool
+      -json command. Returns the list of JSON entries, which leaves out the
+      files Exiftool couldn't read. """
+
+  cmd = ["-json", "-d", DT_FORMAT]
+  for tag in MetaDataDateTime.known_tags:
+    cmd.append("-%s" % tag)
+  cmd += paths
+
+  # Exiftool leaves out the files it can't read, so don't rely on its exit
+  # status but on what ends up in the output
+  result = runExiftool(cmd, pool)
+  with instrument.span("parse json", "parse"):
+    try:
+      return json.loads(result.stdout.decode("utf-8"))
+    except ValueError:
+      return []
+
+def readMetaDataBatch(paths, ignore_read_tags = [], pool = None, chunk_size = 500, cache = None):
+  """ Read the datetime metadata of all files in the paths list, using a single
+      Exiftool -json invocation for each chunk of chunk_size files. Files that
+      are up to date in the MetaDataCache cache, if given, aren't read again.
+      This is a generator yielding a (path, metadata) tuple for each path, in
+      order, where metadata is a MetaDataDateTime object, or None if the
+      metadata couldn't be read. """
+
+  for start in range(0, len(paths), chunk_size):
+    chunk = paths[start:start + chunk_size]
+
+    # The cache may hold values read by the native reader, so don't use them
+    # if it's disabled
+    tag_values = {}
+    if cache and MetaDataDateTime.use_native_reader:
+      for path in chunk:
+        cached = cache.get(path)
+        if cached is not None:
+          tag_values[os.path.normpath(path)] = cached
+
+    # Read what we can without Exiftool
+    to_read = []
+    for path in chunk:
+      if os.path.normpath(path) in tag_values:
+        continue
+      native = _readNativeTagValues(path)
+      if native is not None:
+        tag_values[os.path.normpath(path)] = native
+        if cache:
+          cache.put(path, native)
+      else:
+        to_read.append(path)
+
+    if to_read:
+      try:
+        entries = _readJSONEntries(to_read, pool)
+      except Exception:
+        # Don't let a single file (like a path that can't be passed to
+        # Exiftool) fail the whole chunk, try the files one by one
+        entries = []
+        for path in to_read:
+          try:
+            entries += _readJSONEntries([path], pool)
+          except Exception:
+            pass
+
+      # Match the entries to the paths, Exiftool echoes the path it was given
+      for entry in entries:
+        source = entry.pop("SourceFile", None)
+        if source:
+          values = {tag: str(value) for tag, value in entry.items()}
+          tag_values[os.path.normpath(source)] = values
+          if cache:
+            cache.put(source, values)
+
+    if cache:
+      cache.commit()
+
+    for path in chunk:
+      metadata = None
+      if os.path.normpath(path) in tag_values:
+        try:
+          metadata = MetaDataDateTime(path, ignore_read_tags, pool, tag_values[os.path.normpath(path)], cache)
+        except Exception:
+          metadata = None
+      yield path, metadata
+
 def readCSVFile(path):
   if not os.path.exists(path):
     raise Exception("CSV file doesn't exist")
@@ -149,42 +695,169 @@ def writeCSVFile(path, dt_stamp_pairs):
       if pair:
         out_file.write("%s,%s\n" % (pair[0].strftime(DT_FORMAT), pair[1].strftime(DT_FORMAT)))
 
-def processPhoto(photo_path, reference_points, ignore_read_tags = [], dry_run = False):
+def processPhoto(photo_path, reference_points, ignore_read_tags = [], dry_run = False, pool = None, metadata = None, overwrite_original = False,
+                 cache = None):
   """ Correct the datetime stamp of the photo specified at photo_path, using the
-      reference_points list of tuples to interpolate to the correct time.
-      The results will be printed to stdout / stderr.
+      reference_points list of TimePoints (or a DriftModel) to interpolate to
+      the correct time.
+      Returns a message describing the result, or raises an Exception if the
+      photo couldn't be corrected.
       The ignore_read_tags is a list of tags that shouldn't be used for
       determining the datetime stamp of the photo.
-      If dry_run is True, the photo isn't actually modified. """
+      If dry_run is True, the photo isn't actually modified.
+      Exiftool is run through the ExifToolPool pool, if given.
+      If the MetaDataDateTime of the photo has already been read, it can be
+      passed as metadata.
+      If overwrite_original is True, Exiftool doesn't keep a copy of the
+      original file.
+      The MetaDataCache cache is used for reading the metadata, if given. """
       
-  if not os.path.exists(photo_path):
-    raise Exception("Photo file %s does not exist" % photo_path)
-  
-  try:
-    metadata = MetaDataDateTime(photo_path, ignore_read_tags)
-  except:
-    sys.stderr.write("The date and time couldn't be extracted from %s\n" % photo_path)
-    sys.exit(1)
+  if not metadata:
+    if not os.path.exists(photo_path):
+      raise Exception("Photo file %s does not exist" % photo_path)
+    
+    try:
+      metadata = MetaDataDateTime(photo_path, ignore_read_tags, pool, cache = cache)
+    except:
+      raise Exception("The date and time couldn't be extracted from %s" % photo_path)
   
   # Calculate the correct time
   diff = metadata.calcCorrection(reference_points)
   
   # Write the corrected time to the photo file
   if not dry_run:
-    if metadata.writeMetaData():
-      print("Shifted %s (from %s tag) by %+.0f seconds" % (photo_path, metadata.dt_tag, diff))
+    if metadata.writeMetaData(overwrite_original):
+      return "Shifted %s (from %s tag) by %+.0f seconds" % (photo_path, metadata.dt_tag, diff)
     else:
-      print("Error with %s" % photo_path)
+      raise Exception("Error with %s" % photo_path)
   else:
-    print("%s will be shifted (from %s tag) by %+.0f seconds" % (photo_path, metadata.dt_tag, diff))
+    return "%s will be shifted (from %s tag) by %+.0f seconds" % (photo_path, metadata.dt_tag, diff)
+
+def correctPhotos(photo_paths, reference_points, ignore_read_tags = [], dry_run = False, pool = None, jobs = 1,
+                  overwrite_original = False, group_shifts = False, cache = None):
+  """ Correct all photos in the photo_paths list using processPhoto(), with up
+      to jobs photos being processed at the same time. The metadata is read in
+      bulk while earlier photos are being written.
+      If group_shifts is True, the photos are written with
+      shiftMetaDataBatch() instead, in chunks of photos that are read
+      together.
+      The MetaDataCache cache is used for reading and kept up to date, if
+      given.
+      This is a generator yielding a (path, message, error) tuple for each
+      photo, in the order of photo_paths. Either message or error (the
+      Exception that occurred) is None. """
+
+  # Calculate the interpolation segments only once for the whole batch
+  if not isinstance(reference_points, DriftModel):
+    reference_points = DriftModel(reference_points)
 
-def getPhotoAndUserStringDT(photo_path, ignore_tags):
+  if group_shifts and not dry_run:
+    yield from _correctPhotosGrouped(photo_paths, reference_points, ignore_read_tags, pool, jobs, overwrite_original, cache)
+    return
+
+  with concurrent.futures.ThreadPoolExecutor(max_workers = jobs) as executor:
+    # Keep a bounded number of photos in flight, so memory usage doesn't grow
+    # with the size of the batch and results can be reported in order
+    in_flight = collections.deque()
+
+    def collect():
+      path, future = in_flight.popleft()
+      try:
+        return path, future.result(), None
+      except Exception as e:
+        return path, None, e
+
+    for photo, metadata in readMetaDataBatch(photo_paths, ignore_read_tags, pool, cache = cache):
+      in_flight.append((photo, executor.submit(processPhoto, photo, reference_points,
+                                               ignore_read_tags, dry_run, pool, metadata,
+                                               overwrite_original, cache)))
+      while len(in_flight) > 2 * jobs:
+        yield collect()
+
+    while in_flight:
+      yield collect()
+
+def _correctPhotosGrouped(photo_paths, model, ignore_read_tags, pool, jobs, overwrite_original, cache, chunk_size = 500):
+  """ The group_shifts implementation of correctPhotos(). For each chunk of
+      photos, the corrections are calculated at once and the photos are
+      written in groups of the same shift, spread over the jobs. """
+
+  batch = readMetaDataBatch(photo_paths, ignore_read_tags, pool, chunk_size, cache)
+  with concurrent.futures.ThreadPoolExecutor(max_workers = jobs) as executor:
+    while True:
+      chunk = list(itertools.islice(batch, chunk_size))
+      if not chunk:
+        break
+
+      # Correct all photos of the chunk at once. If that fails, correct them
+      # one by one to find out which ones are the problem.
+      read = [metadata for _, metadata in chunk if metadata]
+      try:
+        corrected = dict(zip(map(id, read), model.correctAll([metadata.dt.timestamp() for metadata in read])))
+      except Exception:
+        corrected = {}
+
+      # Photos that couldn't be read in bulk are handled one by one, so their
+      # errors get reported
+      singles  = {}
+      readable = []
+      errors   = {}
+      for photo, metadata in chunk:
+        if not metadata:
+          singles[photo] = executor.submit(processPhoto, photo, model, ignore_read_tags,
+                                           False, pool, None, overwrite_original, cache)
+        else:
+          try:
+            if id(metadata) in corrected:
+              metadata.setCorrection(corrected[id(metadata)])
+            else:
+              metadata.calcCorrection(model)
+            readable.append(metadata)
+          except Exception as e:
+            errors[photo] = e
+
+      # Spread the readable photos over the jobs, keeping photos with the same
+      # shift together
+      readable.sort(key = lambda metadata: metadata._shift)
+      slice_size = max(1, -(-len(readable) // jobs))
+      writes = [executor.submit(shiftMetaDataBatch, readable[start:start + slice_size], pool, overwrite_original,
+                                cache = cache)
+                for start in range(0, len(readable), slice_size)]
+      failed = set()
+      for write in writes:
+        failed |= write.result()
+
+      for photo, metadata in chunk:
+        if photo in singles:
+          try:
+            yield photo, singles[photo].result(), None
+          except Exception as e:
+            yield photo, None, e
+        elif photo in errors:
+          yield photo, None, errors[photo]
+        elif photo in failed:
+          yield photo, None, Exception("Error with %s" % photo)
+        else:
+          yield photo, "Shifted %s (from %s tag) by %+.0f seconds" % (photo, metadata.dt_tag, metadata._shift), None
+
+def parseUserDT(user_dt_string, photo_date):
+  """ Parse the datetime read from a clock photo, in DT_FORMAT, or in
+      TIME_FORMAT in which case the date is taken from photo_date. Raises a
+      ValueError if the string is in neither format. """
+
+  try:
+    return datetime.datetime.strptime(user_dt_string, DT_FORMAT)
+  except ValueError:
+    user_time = datetime.datetime.strptime(user_dt_string, TIME_FORMAT)
+    return datetime.datetime(photo_date.year, photo_date.month, photo_date.day, user_time.hour, user_time.minute, user_time.second)
+
+def getPhotoAndUserStringDT(photo_path, ignore_read_tags, pool = None, cache = None):
   if not os.path.exists(photo_path):
     sys.stdout.write("Photo file %s does not exist" % photo_path)
     return None
     
   try:
-    photo_dt = MetaDataDateTime(photo_path, ignore_read_tags).dt
+    photo_dt = MetaDataDateTime(photo_path, ignore_read_tags, pool, cache = cache).dt
   except:
     sys.stdout.write("The date and time couldn't be extracted from %s" % photo_path)
     return None
@@ -194,17 +867,102 @@ def getPhotoAndUserStringDT(photo_path, ignore_tags):
   while not user_dt:
     user_dt_string = input("%s (date defaults to %s): " % (photo_path, photo_date.strftime(DATE_FORMAT)))
     try:
-      user_dt = datetime.datetime.strptime(user_dt_string, DT_FORMAT)
+      user_dt = parseUserDT(user_dt_string, photo_date)
     except ValueError:
-      try:
-        user_time = datetime.datetime.strptime(user_dt_string, TIME_FORMAT)
-        user_dt   = datetime.datetime(photo_date.year, photo_date.month, photo_date.day, user_time.hour, user_time.minute, user_time.second)
-      except ValueError:
-        print("Invalid datetime string. Format should be %s or %s" % (DT_FORMAT, TIME_FORMAT))
-        user_dt = None
+      print("Invalid datetime string. Format should be %s or %s" % (DT_FORMAT, TIME_FORMAT))
+      user_dt = None
   
   return (photo_dt, user_dt)
 
+def readPairsFile(path):
+  """ Read the list of (photo path, displayed time) tuples for generating the
+      reference points without asking the user. path is either a CSV file with
+      a photo and the date and time displayed on it on each line, or a
+      directory of clock photos, each with a .txt file with the same name
+      containing the displayed date and time. Only one photo or video is used
+      for each .txt file, other files (backups, XMP sidecars) are ignored.
+      Photo paths in the CSV file are relative to the directory of the CSV
+      file. """
+
+  pairs = []
+  if os.path.isdir(path):
+    photos = {}
+    for file_name in os.listdir(path):
+      base, ext = os.path.splitext(file_name)
+      if ext.lower() not in CLOCK_PHOTO_EXTENSIONS or not os.path.isfile(os.path.join(path, base + ".txt")):
+        continue
+      if base not in photos or (CLOCK_PHOTO_EXTENSIONS.index(ext.lower()) <
+                                CLOCK_PHOTO_EXTENSIONS.index(os.path.splitext(photos[base])[1].lower())):
+        photos[base] = file_name
+
+    for base in sorted(photos):
+      with open(os.path.join(path, base + ".txt"), "r") as in_file:
+        pairs.append((os.path.join(path, photos[base]), in_file.readline().strip()))
+  elif os.path.exists(path):
+    csv_dir = os.path.dirname(path)
+    with open(path, "r") as in_file:
+      for line in in_file.readlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+          continue
+        try:
+          photo, displayed = line.rsplit(",", 1)
+        except ValueError:
+          raise Exception("Pairs file not correctly formatted")
+        pairs.append((os.path.join(csv_dir, photo.strip()), displayed.strip()))
+  else:
+    raise Exception("Pairs file doesn't exist")
+
+  return pairs
+
+def generateReferencePoints(pairs, ignore_read_tags = [], pool = None, cache = None):
+  """ Read the exif datetime of all photos in the list of (photo path,
+      displayed time) pairs in one batch, and combine it with the displayed
+      time. Returns a list of (photo path, exif datetime, real datetime)
+      tuples sorted by exif datetime, and a list of error messages for the
+      pairs that couldn't be used. Only the first of the photos with the same
+      exif datetime is used, since the drift can't be determined from points
+      at the same time. """
+
+  points = []
+  errors = []
+  metadatas = readMetaDataBatch([photo for photo, _ in pairs], ignore_read_tags, pool, cache = cache)
+  for (photo, metadata), (_, displayed) in zip(metadatas, pairs):
+    if not metadata or not metadata.dt:
+      errors.append("The date and time couldn't be extracted from %s" % photo)
+      continue
+    try:
+      user_dt = parseUserDT(displayed, metadata.dt.date())
+    except ValueError:
+      errors.append("Invalid datetime string '%s' for %s. Format should be %s or %s" % (displayed, photo, DT_FORMAT, TIME_FORMAT))
+      continue
+    points.append((photo, metadata.dt, user_dt))
+
+  points.sort(key = lambda point: point[1])
+  unique_points = []
+  for point in points:
+    if unique_points and unique_points[-1][1] == point[1]:
+      errors.append("%s has the same exif time as %s, skipping it" % (point[0], unique_points[-1][0]))
+      continue
+    unique_points.append(point)
+  return unique_points, errors
+
+def leaveOneOutResiduals(dt_pairs):
+  """ Check how well each of the (exif datetime, real datetime) pairs agrees
+      with the others, by predicting its real time from the DriftModel of all
+      other pairs. Returns the list of differences between the predicted and
+      the real time in seconds, with None where no prediction can be made. """
+
+  points = [TimePoint(exif.timestamp(), real.timestamp()) for exif, real in dt_pairs]
+  residuals = []
+  for i, point in enumerate(points):
+    others = sorted(points[:i] + points[i + 1:], key = lambda other: other.exif)
+    try:
+      residuals.append(DriftModel(others).correct(point.exif) - point.real)
+    except Exception:
+      residuals.append(None)
+  return residuals
+
 if __name__ == "__main__":
   # Build a parser and parse the command line
   parser = argparse.ArgumentParser(description = "Correct the time for a given photo based on a list of samples of clock drift.")
@@ -212,15 +970,38 @@ if __name__ == "__main__":
                       help = "The mode, can be either 'g/generate' to generate the csv file based on the supplied images, or 'c/correct' to process the supplied images based on the csv file.") 
   parser.add_argument("-n", "--dry-run", action = "store_true",
                       help = "Don't alter any files, just print out what would be done. Only has an effect in correct mode.")
+  parser.add_argument("-o", "--overwrite-original", action = "store_true",
+                      help = "Don't keep a copy of the original files (by default, Exiftool saves them with \"_original\" appended to the file name). Only has an effect in correct mode.")
+  parser.add_argument("-g", "--group-shifts", action = "store_true",
+                      help = "Shift all datetime tags relative to their current value instead of setting them to the corrected time, and write photos with the same shift with a single Exiftool command. Only has an effect in correct mode.")
+  cache_group = parser.add_mutually_exclusive_group()
+  cache_group.add_argument("--cache", type = str,
+                           help = "The file to cache the datetime metadata of the photos in, so they don't need to be read again on the next run. Defaults to metadata.sqlite in the photoandvideoscripts directory of the XDG cache directory.")
+  cache_group.add_argument("--no-cache", action = "store_true",
+                           help = "Don't use the metadata cache.")
+  parser.add_argument("--no-native", action = "store_true",
+                      help = "Always use Exiftool for reading the datetime, also for JPEG and MP4/MOV files that can be read without it. Cached values aren't used either, but the cache is updated.")
+  parser.add_argument("-p", "--pairs", type = str,
+                      help = "Generate the csv file without asking for the displayed times, from a CSV file where each row contains a photo and the date and time displayed on it (in format \"yyyy-mm-dd hh:mm:ss\" or just \"hh:mm:ss\"), or from a directory of photos that each have a .txt file with the displayed time. Only has an effect in generate mode.")
+  parser.add_argument("-j", "--jobs", type = int, default = 1,
+                      help = "The number of photos to correct at the same time. Only has an effect in correct mode.")
   tag_group = parser.add_mutually_exclusive_group()
   tag_group.add_argument("-i", "--ignore-reading",
                          choices = MetaDataDateTime.known_tags,
                          action = "append",
                          help = "Ignore this tag for reading the datetime (it will be included when writing though). This tag can be used multiple times.")
+  instrument.addArguments(parser)
   parser.add_argument('csv_file', type = str, help = "The CSV file with the time samples. Its rows should contain exif and actual time seperated by a comma, both in format \"yyyy-mm-dd hh:mm:ss\". This file will be overwritten in generate mode.")
-  parser.add_argument('photo', type = str, nargs = "+", help = "The photo files to use as reference images (in generate mode) or that need to be corrected (in correct mode.")
+  parser.add_argument('photo', type = str, nargs = "*", help = "The photo files to use as reference images (in generate mode) or that need to be corrected (in correct mode.")
   
   args = parser.parse_args()
+  instrument.enableFromArgs(args)
+
+  if args.mode in ['g', 'generate'] and args.pairs:
+    if args.photo:
+      parser.error("Photos can't be given together with --pairs")
+  elif not args.photo:
+    parser.error("At least one photo is needed")
  
   # Check if exiftool is there
   try:
@@ -231,12 +1012,69 @@ if __name__ == "__main__":
     raise Exception("Exiftool can't be run")
 
   ignore_read_tags = args.ignore_reading if args.ignore_reading else []
+  MetaDataDateTime.use_native_reader = not args.no_native
 
-  if args.mode in ['g', 'generate']:
-    print("What are the date en time (%s), or just time (%s) if the default date is correct, displayed on photo:" % (DT_FORMAT, TIME_FORMAT))
-    dt_stamps = [getPhotoAndUserStringDT(photo, ignore_read_tags) for photo in args.photo]
-    writeCSVFile(args.csv_file, dt_stamps)
-  elif args.mode in ['c', 'correct']:
-    reference_points = readCSVFile(args.csv_file)
-    for photo in args.photo:
-      processPhoto(photo, reference_points, ignore_read_tags, args.dry_run)
+  if args.jobs < 1:
+    parser.error("The number of jobs should be at least 1")
+
+  # Open the metadata cache. It's just an optimization, so carry on without it
+  # if that doesn't work out.
+  cache = None
+  if not args.no_cache:
+    try:
+      cache = MetaDataCache(args.cache)
+    except (OSError, sqlite3.Error) as e:
+      sys.stderr.write("Not using the metadata cache: %s\n" % e)
+
+  # Keep the Exiftool processes running for the whole batch, one for each job
+  # plus one for reading the metadata
+  failures = []
+  with ExifToolPool(args.jobs + 1) as pool:
+    if args.mode in ['g', 'generate'] and args.pairs:
+      try:
+        pairs = readPairsFile(args.pairs)
+      except Exception as e:
+        sys.stderr.write("%s\n" % e)
+        sys.exit(1)
+      points, errors = generateReferencePoints(pairs, ignore_read_tags, pool, cache)
+      for error in errors:
+        sys.stderr.write("%s\n" % error)
+      failures = errors
+      writeCSVFile(args.csv_file, [(exif, real) for _, exif, real in points])
+      print("Wrote %d reference points to %s" % (len(points), args.csv_file))
+
+      # Show how well each point fits the drift model of the others, to spot
+      # misread clocks
+      if len(points) >= 3:
+        residuals = leaveOneOutResiduals([(exif, real) for _, exif, real in points])
+        print("Difference with the time predicted by the other points:")
+        for (photo, exif, real), residual in zip(points, residuals):
+          print("  %s  %s -> %s  %s" % (exif.strftime(DT_FORMAT), real.strftime(DT_FORMAT),
+                                        "n/a" if residual is None else "%+ds" % residual, photo))
+    elif args.mode in ['g', 'generate']:
+      print("What are the date en time (%s), or just time (%s) if the default date is correct, displayed on photo:" % (DT_FORMAT, TIME_FORMAT))
+      dt_stamps = [getPhotoAndUserStringDT(photo, ignore_read_tags, pool, cache) for photo in args.photo]
+      writeCSVFile(args.csv_file, dt_stamps)
+    elif args.mode in ['c', 'correct']:
+      with instrument.span("read CSV", "io"):
+        reference_points = readCSVFile(args.csv_file)
+
+      # Report the results as they come in, and the failures at the end
+      for photo, message, error in correctPhotos(args.photo, reference_points, ignore_read_tags, args.dry_run, pool, args.jobs,
+                                                   args.overwrite_original, args.group_shifts, cache):
+        if error:
+          sys.stderr.write("%s\n" % error)
+          failures.append(photo)
+        else:
+          print(message)
+
+      if failures:
+        sys.stderr.write("%d of %d photos couldn't be corrected:\n" % (len(failures), len(args.photo)))
+        for photo in failures:
+          sys.stderr.write("  %s\n" % photo)
+
+  if cache:
+    cache.close()
+
+  if failures:
+    sys.exit(1)
@@ -1,19 +1,309 @@
 #!/usr/bin/env python3
 
-import argparse, os, re, subprocess, sys
+import argparse, collections, concurrent.futures, mmap, os, re, shutil, struct, subprocess, sys, tempfile, time
+
+import instrument
+
+# The names of the blocks in the Samsung trailer that we know to be part of the
+# Motion Photo, and can be removed with it
+MOTION_PHOTO_BLOCKS = ["Image_UTC_Data", "MotionPhoto_Data", "MotionPhoto_Version"]
+
+class MotionPhotoException(Exception):
+    pass
 
 def failWithMessage(message):
     print(message)
     sys.exit(1)
 
+def readSamsungTrailer(jpg_file):
+    """ Find the Samsung trailer at the end of the jpg file without Exiftool.
+        The trailer ends with a directory of data blocks, followed by its
+        length and the "SEFT" signature. Returns the offset of the trailer and
+        a dict mapping the block names to (offset, length) tuples of their
+        data, or None if there's no (valid) Samsung trailer. """
+
+    with open(jpg_file, "rb") as jpg:
+        if os.fstat(jpg.fileno()).st_size < 8:
+            return None
+        with mmap.mmap(jpg.fileno(), 0, access = mmap.ACCESS_READ) as data:
+            if data[-4:] != b"SEFT":
+                return None
+
+            # The directory starts with "SEFH", the version and the number of
+            # blocks, followed by a 12 byte entry for each block
+            dir_pos = len(data) - 8 - struct.unpack("<I", data[-8:-4])[0]
+            if dir_pos < 0 or data[dir_pos:dir_pos + 4] != b"SEFH":
+                return None
+            count = struct.unpack("<I", data[dir_pos + 8:dir_pos + 12])[0]
+
+            offset = dir_pos
+            blocks = {}
+            for i in range(count):
+                entry = dir_pos + 12 + 12 * i
+                if entry + 12 > len(data):
+                    return None
+
+                # Each entry holds the distance from the block to the directory
+                # and the block size. The block itself starts with its type,
+                # the length of its name and the name, followed by the data.
+                _, distance, size = struct.unpack("<III", data[entry:entry + 12])
+                block_pos = dir_pos - distance
+                if block_pos < 0 or block_pos + size > dir_pos:
+                    return None
+                name_length = struct.unpack("<I", data[block_pos + 4:block_pos + 8])[0]
+                if 8 + name_length > size:
+                    return None
+                name = data[block_pos + 8:block_pos + 8 + name_length].decode("ascii", "replace")
+                blocks[name] = (block_pos + 8 + name_length, size - 8 - name_length)
+                offset = min(offset, block_pos)
+
+            # Make sure the video really is an MP4 movie
+            if "MotionPhoto_Data" in blocks:
+                video_offset, video_length = blocks["MotionPhoto_Data"]
+                if video_length < 8 or data[video_offset + 4:video_offset + 8] != b"ftyp":
+                    return None
+
+    return offset, blocks
+
+def copyRange(src_file, dst_file, offset, length):
+    """ Copy length bytes from offset in the src_file to the (new) dst_file,
+        letting the kernel do the work where possible. """
+
+    with open(src_file, "rb") as src, open(dst_file, "wb") as dst:
+        remaining = length
+        try:
+            while remaining > 0:
+                copied = os.copy_file_range(src.fileno(), dst.fileno(), remaining, offset + length - remaining)
+                if copied == 0:
+                    break
+                remaining -= copied
+        except (AttributeError, OSError):
+            # No copy_file_range (not Linux, or across file systems that don't
+            # support it), try sendfile
+            try:
+                while remaining > 0:
+                    copied = os.sendfile(dst.fileno(), src.fileno(), offset + length - remaining, remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+            except (AttributeError, OSError):
+                # Do it the old-fashioned way, without reading it all at once
+                src.seek(offset + length - remaining)
+                dst.seek(length - remaining)
+                while remaining > 0:
+                    chunk = src.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    dst.write(chunk)
+                    remaining -= len(chunk)
+
+    if remaining > 0:
+        raise MotionPhotoException("Couldn't extract the embedded video")
+
+def extractWithExiftool(jpg_file, mp4_file):
+    """ Extract the embedded video using Exiftool. """
+
+    # Check the EmbeddedVideoType flag, should be "MotionPhoto_Data" for Samsung
+    # Motion Photos
+    result = subprocess.run(["exiftool", "-S", "-EmbeddedVideoType", jpg_file], stdout = subprocess.PIPE)
+    if result.returncode != 0:
+        raise MotionPhotoException("Exiftool failed on %s" % jpg_file)
+    stdout = result.stdout.decode("utf-8").split(":")
+    if len(stdout) != 2 or stdout[1].strip() != "MotionPhoto_Data":
+        raise MotionPhotoException("'%s' is probably not a Samsung Motion Photo" % jpg_file)
+
+    result = subprocess.run(["exiftool", "-b", "-EmbeddedVideoFile", jpg_file], stdout = subprocess.PIPE)
+    if result.returncode != 0:
+        raise MotionPhotoException("Couldn't extract the embedded video")
+    with instrument.span("write video", "io") as timed, open(mp4_file, "wb") as mp4:
+        timed.bytes_out = mp4.write(result.stdout)
+
+def findTrailerWithExiftool(jpg_file):
+    """ Ask Exiftool where the Samsung trailer starts, and check that there's
+        only an embedded video in it. Returns the offset of the trailer. """
+
+    result = subprocess.run(["exiftool", "-v1", jpg_file], stdout = subprocess.PIPE)
+    if result.returncode != 0:
+        raise MotionPhotoException("Couldn't remove the embedded video")
+    stdout = result.stdout.decode("UTF-8")
+
+    # Do a sanity check to see if there's only an embedded video in the JPG
+    # trailer
+    offset = None
+    in_samsung_section = False
+    for line in stdout.split("\n"):
+        if not in_samsung_section and line.startswith("Samsung trailer"):
+            in_samsung_section = True
+
+            # While we're here, extract the offset of the Samsung trailer
+            offset_match = re.search("Samsung trailer \(\d+ bytes at offset (0x[\da-f]+)", line)
+            if offset_match:
+                offset = offset_match.group(1)
+            else:
+                raise MotionPhotoException("Couldn't remove the embedded video")
+
+        elif in_samsung_section:
+            if line.startswith("  "):
+                if not re.match("  (Samsung_Trailer|TimeStamp|SamsungTrailer|EmbeddedVideo)", line):
+                    raise MotionPhotoException("Unknown content found in Samsung portion of the file. Embedded video couldn't be removed")
+            else:
+                in_samsung_section = False
+
+    if offset == None:
+        raise MotionPhotoException("Couldn't remove the embedded video")
+
+    return int(offset, 16)
+
+def extractMotionPhoto(jpg_file, split = False):
+    """ Save the video embedded in the Samsung Motion Photo jpg_file as an mp4
+        file with the same base name, and copy the metadata to it. If split is
+        True, the video is removed from the jpg file as well.
+        The trailer is parsed directly if possible, which avoids reading the
+        video into memory. Exiftool is used for anything we don't recognize.
+        The video is written to a temporary file in the same directory first,
+        which replaces the mp4 file when done, so an interrupted run never
+        leaves a partial mp4 file behind.
+        Returns the name of the mp4 file. Raises a MotionPhotoException on
+        failure. """
+
+    if not os.path.exists(jpg_file):
+        raise MotionPhotoException("Photo file %s does not exist" % jpg_file)
+
+    base, _ = os.path.splitext(jpg_file)
+    mp4_file = base + ".mp4"
+
+    with instrument.span("parse trailer", "parse"):
+        trailer = readSamsungTrailer(jpg_file)
+
+    mp4_dir, mp4_name = os.path.split(os.path.abspath(mp4_file))
+    fd, temp_file = tempfile.mkstemp(dir = mp4_dir, prefix = "." + mp4_name + ".", suffix = ".mp4")
+    os.close(fd)
+    try:
+        if trailer and "MotionPhoto_Data" in trailer[1]:
+            video_offset, video_length = trailer[1]["MotionPhoto_Data"]
+            with instrument.span("copy video", "io") as timed:
+                copyRange(jpg_file, temp_file, video_offset, video_length)
+                timed.bytes_in = timed.bytes_out = video_length
+        else:
+            extractWithExiftool(jpg_file, temp_file)
+
+        result_metadata = subprocess.run(["exiftool", "-overwrite_original", "-tagsfromfile", jpg_file, temp_file], stdout = subprocess.PIPE)
+        if result_metadata.returncode != 0:
+            print("Warning: couldn't copy metadata to mp4 file")
+
+        shutil.copymode(jpg_file, temp_file)
+        os.replace(temp_file, mp4_file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+    if split:
+        # The embedded video is basically pasted to the end of the jpg file, so
+        # removing it basically means cutting the tail off the jpg file. If the
+        # trailer contains anything we don't know about, let Exiftool have a
+        # look at it.
+        if trailer and all(name in MOTION_PHOTO_BLOCKS for name in trailer[1]):
+            offset = trailer[0]
+        else:
+            offset = findTrailerWithExiftool(jpg_file)
+
+        with instrument.span("truncate photo", "io"):
+            os.truncate(jpg_file, offset)
+
+        # Keep the mp4 file newer than the jpg file, so it's seen as up to date
+        os.utime(mp4_file)
+
+    return mp4_file
+
+def hasSamsungTrailer(jpg_file):
+    """ Quickly check if the jpg file ends with the Samsung trailer signature. """
+
+    try:
+        with open(jpg_file, "rb") as jpg:
+            jpg.seek(0, os.SEEK_END)
+            if jpg.tell() < 4:
+                return False
+            jpg.seek(-4, os.SEEK_END)
+            return jpg.read(4) == b"SEFT"
+    except OSError:
+        return False
+
+def mayHaveMotionPhoto(jpg_file):
+    """ Check if the jpg file could be a Motion Photo, that is, if it has a
+        Samsung trailer that we can't rule out holding a video. Samsung also
+        uses the trailer for other data, so a trailer that we can parse without
+        a MotionPhoto_Data block doesn't count. """
+
+    if not hasSamsungTrailer(jpg_file):
+        return False
+    try:
+        trailer = readSamsungTrailer(jpg_file)
+    except (OSError, ValueError, struct.error):
+        # Leave it to Exiftool
+        return True
+    return trailer is None or "MotionPhoto_Data" in trailer[1]
+
+def isExtracted(jpg_file):
+    """ Check if the mp4 file for the jpg file exists and is up to date. """
+
+    mp4_file = os.path.splitext(jpg_file)[0] + ".mp4"
+    try:
+        return os.path.getmtime(mp4_file) >= os.path.getmtime(jpg_file)
+    except OSError:
+        return False
+
+def findPhotos(paths):
+    """ Generate (path, from_dir) tuples for the files in the list of paths, and
+        for all jpg files in the directories in it (recursively). from_dir
+        tells if the file was found in a directory. """
+
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    if os.path.splitext(file_name)[1].lower() in (".jpg", ".jpeg"):
+                        yield os.path.join(dir_path, file_name), True
+        else:
+            yield path, False
+
+def processPhoto(jpg_file, from_dir, split, force):
+    """ Extract the video from the jpg_file if needed. Files found in a
+        directory are skipped if they don't look like a Motion Photo.
+        Returns a (status, mp4 file or error message, bytes) tuple, where status
+        is one of "extracted", "up to date", "skipped" or "failed". """
+
+    if from_dir and not mayHaveMotionPhoto(jpg_file):
+        return "skipped", None, 0
+    if not force and isExtracted(jpg_file):
+        return "up to date", None, 0
+
+    try:
+        with instrument.span("extract motion photo", "stage"):
+            mp4_file = extractMotionPhoto(jpg_file, split)
+    except (MotionPhotoException, OSError) as e:
+        return "failed", str(e), 0
+    return "extracted", mp4_file, os.path.getsize(mp4_file)
+
 if __name__ == "__main__":
     # Build a parser and parse the command line
     parser = argparse.ArgumentParser(description = "Extract the	 embedded video from a Samsung Motion Photo.")
     parser.add_argument("-s", "--split", action = "store_true",
                         help = "Split the files, that is, remove the embedded video from the jpg file as well. WARNING: use at your own risk - it might be a good idea to make a backup first.")
-    parser.add_argument("jpg_file", type = str, help = "The photo file that should contain the embedded video")
+    parser.add_argument("-f", "--force", action = "store_true",
+                        help = "Also extract the video if the mp4 file already exists and is newer than the jpg file.")
+    parser.add_argument("-j", "--jobs", type = int, default = os.cpu_count() or 1,
+                        help = "The number of photos to process at the same time (defaults to the number of processors).")
+    parser.add_argument("jpg_file", type = str, nargs = "+",
+                        help = "The photo files that should contain the embedded video, or directories to search (recursively) for Motion Photos")
+    instrument.addArguments(parser)
     args = parser.parse_args()
- 
+    instrument.enableFromArgs(args)
+
+    if args.jobs < 1:
+        parser.error("The number of jobs should be at least 1")
+
     # Check if exiftool is there
     try:
         status = subprocess.run(["exiftool", "-ver"], stdout = subprocess.PIPE)
@@ -22,69 +312,39 @@ if __name__ == "__main__":
     if status.returncode != 0:
         failWithMessage("Exiftool can't be run")
 
-    if not os.path.exists(args.jpg_file):
-        failWithMessage("Photo file %s does not exist" % args.jpg_file)
+    start_time = time.time()
+    counts = collections.Counter()
+    total_bytes = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers = args.jobs) as executor:
+        # Keep a bounded number of photos in flight, and report in order
+        in_flight = collections.deque()
 
-    # Check the EmbeddedVideoType flag, should be "MotionPhoto_Data" for Samsung
-    # Motion Photos
-    result = subprocess.run(["exiftool", "-S", "-EmbeddedVideoType", args.jpg_file], stdout = subprocess.PIPE)
-    if result.returncode != 0:
-        failWithMessage("Exiftool failed on %s" % args.jpg_file)
-    stdout = result.stdout.decode("utf-8").split(":")
-    if len(stdout) != 2 or stdout[1].strip() != "MotionPhoto_Data":
-        failWithMessage("'%s' is probably not a Samsung Motion Photo" % args.jpg_file)
-    
-    # If we're good, extract the embedded video and copy the metadata
-    base, _ = os.path.splitext(args.jpg_file)
-    result = subprocess.run(["exiftool", "-b", "-EmbeddedVideoFile", args.jpg_file], stdout = subprocess.PIPE)
-    if result.returncode != 0:
-        failWithMessage("Couldn't extract the embedded video")
-    else:
-        with open(base + ".mp4", "wb") as mp4:
-            mp4.write(result.stdout)
-        print("Embedded video saved as '%s.mp4'" % base)
-        result_metadata = subprocess.run(["exiftool", "-overwrite_original", "-tagsfromfile", args.jpg_file, base + ".mp4"], stdout = subprocess.PIPE)
-        if result_metadata.returncode != 0:
-            print("Warning: couldn't copy metadata to mp4 file")
+        def report():
+            global total_bytes
+            jpg_file, from_dir, future = in_flight.popleft()
+            status, result, size = future.result()
+            counts[status] += 1
+            total_bytes += size
+            if status == "extracted":
+                print("Embedded video saved as '%s'" % result)
+            elif status == "failed":
+                print(result)
+            elif status == "up to date" and not from_dir:
+                print("The video of '%s' is already extracted" % jpg_file)
 
-    if args.split:
-        # The embedded video is basically pasted to the end of the jpg file, so
-        # removing it basically means cutting the tail off the jpg file. Let's
-        # ask Exiftool where we should cut.
-        # NOTE: we could use this same mechanism to extract the video, but it's
-        #       a bit safer to just use Exiftool for this.
-        result = subprocess.run(["exiftool", "-v1", args.jpg_file], stdout = subprocess.PIPE)
-        if result.returncode != 0:
-            failWithMessage("Couldn't remove the embedded video")
-        stdout = result.stdout.decode("UTF-8")
-
-        # Do a sanity check to see if there's only an embedded video in the JPG
-        # trailer
-        offset = None
-        in_samsung_section = False
-        for line in stdout.split("\n"):
-            if not in_samsung_section and line.startswith("Samsung trailer"):
-                in_samsung_section = True
-
-                # While we're here, extract the offset of the Samsung trailer                
-                offset_match = re.search("Samsung trailer \(\d+ bytes at offset (0x[\da-f]+)", line)
-                if offset_match:
-                    offset = offset_match.group(1)
-                else:
-                    failWithMessage("Couldn't remove the embedded video")
-
-            elif in_samsung_section:
-                if line.startswith("  "):
-                    if not re.match("  (Samsung_Trailer|TimeStamp|SamsungTrailer|EmbeddedVideo)", line):
-                        failWithMessage("Unknown content found in Samsung portion of the file. Embedded video couldn't be removed")
-                else:
-                    in_samsung_section = False
-
-        if offset == None:
-            failWithMessage("Couldn't remove the embedded video")
-
-        # Save a trunctated version of the jpg file up to the offset
-        with open(args.jpg_file, "rb") as jpg_file:
-            jpg_data = jpg_file.read(int(offset, 16))
-        with open(args.jpg_file, "wb") as jpg_file:
-            jpg_file.write(jpg_data)
+        for jpg_file, from_dir in findPhotos(args.jpg_file):
+            in_flight.append((jpg_file, from_dir, executor.submit(processPhoto, jpg_file, from_dir, args.split, args.force)))
+            while len(in_flight) > 4 * args.jobs:
+                report()
+        while in_flight:
+            report()
+
+    # Only bother with a summary for batches
+    if sum(counts.values()) > 1:
+        elapsed = max(time.time() - start_time, 0.001)
+        print("Processed %d files in %.1f seconds (%.1f files/s): %d videos extracted (%.1f MB, %.1f MB/s), %d already up to date, %d not Motion Photos, %d failed" %
+              (sum(counts.values()), elapsed, sum(counts.values()) / elapsed, counts["extracted"],
+               total_bytes / 1e6, total_bytes / 1e6 / elapsed, counts["up to date"], counts["skipped"], counts["failed"]))
+
+    if counts["failed"]:
+        sys.exit(1)
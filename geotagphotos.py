@@ -0,0 +1,334 @@
+#!/usr/bin/env python3
+
+""" Add the GPS position to photos by looking up their (drift-corrected) time
+    in a GPS track. """
+
+import argparse, array, calendar, csv, datetime, math, os, re, sqlite3, subprocess, sys, tempfile
+import xml.etree.ElementTree as ElementTree
+
+from correctphotodrift import DriftModel, ExifToolPool, MetaDataCache, MetaDataDateTime, failedPaths, readCSVFile, readMetaDataBatch, runExiftool
+
+RE_ISO_TIME   = re.compile(r"^(\d{4})-(\d{2})-(\d{2})T(\d{2}):(\d{2}):(\d{2}(?:\.\d+)?)(Z|[+-]\d{2}:?\d{2})?$")
+RE_UTC_OFFSET = re.compile(r"^([+-])(\d{1,2})(?::?(\d{2}))?$")
+
+class Track:
+  """ A GPS track, stored as parallel arrays of the UTC timestamps, latitudes,
+      longitudes and altitudes (NaN if unknown) of its points, sorted by time.
+      Arrays of doubles keep even very long tracks compact. """
+
+  def __init__(self, points):
+    """ Build the track from an iterable of (timestamp, latitude, longitude,
+        altitude) tuples, in any order. Of points with the same time, the last
+        one is kept. """
+
+    by_time = {point[0]: point for point in points}
+    self.times      = array.array("d")
+    self.latitudes  = array.array("d")
+    self.longitudes = array.array("d")
+    self.altitudes  = array.array("d")
+    for stamp in sorted(by_time):
+      _, latitude, longitude, altitude = by_time[stamp]
+      self.times.append(stamp)
+      self.latitudes.append(latitude)
+      self.longitudes.append(longitude)
+      self.altitudes.append(altitude)
+
+  def __len__(self):
+    return len(self.times)
+
+  def positions(self, stamps, max_gap):
+    """ Return the (latitude, longitude, altitude) position for each of the
+        UTC timestamps in stamps, interpolated between the track points before
+        and after it. The position is None for timestamps outside of the track,
+        or between two points more than max_gap seconds apart. The stamps are
+        handled in order of time, so the track only needs to be walked once. """
+
+    result = [None] * len(stamps)
+    times = self.times
+    if not times:
+      return result
+
+    i = 0
+    for index in sorted(range(len(stamps)), key = stamps.__getitem__):
+      stamp = stamps[index]
+      if stamp < times[0] or stamp > times[-1]:
+        continue
+
+      # Move to the last point at or before the stamp
+      while i + 1 < len(times) and times[i + 1] <= stamp:
+        i += 1
+
+      if times[i] == stamp:
+        result[index] = (self.latitudes[i], self.longitudes[i], self.altitudes[i])
+        continue
+      if times[i + 1] - times[i] > max_gap:
+        continue
+
+      fraction = (stamp - times[i]) / (times[i + 1] - times[i])
+      result[index] = tuple(values[i] + (values[i + 1] - values[i]) * fraction
+                            for values in (self.latitudes, self.longitudes, self.altitudes))
+    return result
+
+def parseISOTime(value):
+  """ Parse a GPX time (ISO 8601, UTC unless specified otherwise) into a
+      timestamp. Raises a ValueError if it isn't formatted correctly. """
+
+  match = RE_ISO_TIME.match(value.strip())
+  if not match:
+    raise ValueError("Invalid time '%s'" % value)
+  year, month, day, hour, minute = [int(group) for group in match.groups()[:5]]
+  stamp = calendar.timegm((year, month, day, hour, minute, 0)) + float(match.group(6))
+  zone = match.group(7)
+  if zone and zone != "Z":
+    sign = 1 if zone[0] == "+" else -1
+    stamp -= sign * (int(zone[1:3]) * 60 + int(zone[-2:])) * 60
+  return stamp
+
+def readGPX(path):
+  """ Generate the (timestamp, latitude, longitude, altitude) tuples of all
+      track points with a time in the GPX file. The file is parsed
+      incrementally, so large tracks don't need to be loaded as a whole. """
+
+  for _, element in ElementTree.iterparse(path):
+    # Ignore the GPX namespace, there are multiple versions around
+    if element.tag.rsplit("}", 1)[-1] != "trkpt":
+      continue
+
+    stamp = None
+    altitude = math.nan
+    for child in element:
+      name = child.tag.rsplit("}", 1)[-1]
+      if name == "time" and child.text:
+        stamp = parseISOTime(child.text)
+      elif name == "ele" and child.text:
+        altitude = float(child.text)
+    if stamp is not None:
+      yield stamp, float(element.get("lat")), float(element.get("lon")), altitude
+    element.clear()
+
+def _parseNMEACoordinate(value, hemisphere):
+  """ Convert a NMEA (d)ddmm.mmmm coordinate to signed degrees. """
+
+  degrees, minutes = divmod(float(value), 100)
+  coordinate = degrees + minutes / 60
+  return -coordinate if hemisphere in ("S", "W") else coordinate
+
+def readNMEA(path):
+  """ Return the (timestamp, latitude, longitude, altitude) tuples of the
+      fixes in the NMEA log file. The RMC sentences give the date and
+      position, GGA sentences add the altitude. GGA sentences before the first
+      RMC sentence are skipped, since they don't tell the date. """
+
+  date = None
+  fixes = {}
+  with open(path, "r", errors = "replace") as in_file:
+    for line in in_file:
+      line = line.strip()
+      if not line.startswith("$"):
+        continue
+
+      # Skip sentences with a wrong checksum
+      sentence, _, checksum = line[1:].partition("*")
+      if checksum:
+        calculated = 0
+        for char in sentence:
+          calculated ^= ord(char)
+        try:
+          if calculated != int(checksum[:2], 16):
+            continue
+        except ValueError:
+          continue
+
+      fields = sentence.split(",")
+      try:
+        if fields[0][2:] == "RMC" and len(fields) > 9:
+          if fields[2] != "A" or not fields[1] or not fields[9]:
+            continue
+          date = (2000 + int(fields[9][4:6]), int(fields[9][2:4]), int(fields[9][0:2]))
+          stamp = calendar.timegm(date + (int(fields[1][0:2]), int(fields[1][2:4]), 0)) + float(fields[1][4:])
+          altitude = fixes[stamp][3] if stamp in fixes else math.nan
+          fixes[stamp] = (stamp, _parseNMEACoordinate(fields[3], fields[4]), _parseNMEACoordinate(fields[5], fields[6]), altitude)
+        elif fields[0][2:] == "GGA" and len(fields) > 9 and date:
+          if fields[6] in ("", "0") or not fields[1]:
+            continue
+          stamp = calendar.timegm(date + (int(fields[1][0:2]), int(fields[1][2:4]), 0)) + float(fields[1][4:])
+          fixes[stamp] = (stamp, _parseNMEACoordinate(fields[2], fields[3]), _parseNMEACoordinate(fields[4], fields[5]),
+                          float(fields[9]) if fields[9] else math.nan)
+      except ValueError:
+        continue
+
+  return fixes.values()
+
+def readTrack(paths):
+  """ Read the GPX and NMEA files in the list of paths into a single Track. """
+
+  points = []
+  for path in paths:
+    with open(path, "rb") as in_file:
+      is_gpx = in_file.read(256).lstrip().startswith(b"<")
+    points.extend(readGPX(path) if is_gpx else readNMEA(path))
+  return Track(points)
+
+def parseUTCOffset(value):
+  """ Parse a UTC offset like +02:00, -0530 or +1 into seconds. """
+
+  match = RE_UTC_OFFSET.match(value.strip())
+  if not match:
+    raise ValueError("Invalid UTC offset '%s'" % value)
+  seconds = (int(match.group(2)) * 60 + int(match.group(3) or 0)) * 60
+  return seconds if match.group(1) == "+" else -seconds
+
+def photoTimestamp(metadata, drift_model = None, utc_offset = None):
+  """ Return the UTC timestamp at which the photo with the MetaDataDateTime
+      metadata was taken, corrected with the DriftModel drift_model if given.
+      The camera time is taken to be utc_offset seconds ahead of UTC, or in
+      the local time zone of this computer if utc_offset is None. """
+
+  if utc_offset is None:
+    stamp = metadata.dt.timestamp()
+  else:
+    stamp = metadata.dt.replace(tzinfo = datetime.timezone.utc).timestamp() - utc_offset
+  if drift_model:
+    stamp += metadata.calcCorrection(drift_model)
+  return stamp
+
+def writeGPSBatch(geotags, pool = None, overwrite_original = False, chunk_size = 500):
+  """ Write the GPS tags for the list of (path, UTC timestamp, (latitude,
+      longitude, altitude)) tuples. The values for each chunk of chunk_size
+      files are passed to a single Exiftool command in a CSV file.
+      Returns the set of paths that couldn't be written. """
+
+  failed = set()
+  for start in range(0, len(geotags), chunk_size):
+    chunk = geotags[start:start + chunk_size]
+    paths = [path for path, _, _ in chunk]
+
+    with tempfile.NamedTemporaryFile("w", suffix = ".csv", newline = "", delete = False) as csv_file:
+      writer = csv.writer(csv_file)
+      writer.writerow(["SourceFile", "GPSLatitude", "GPSLatitudeRef", "GPSLongitude", "GPSLongitudeRef",
+                       "GPSAltitude", "GPSAltitudeRef", "GPSDateStamp", "GPSTimeStamp"])
+      for path, stamp, (latitude, longitude, altitude) in chunk:
+        utc = datetime.datetime.fromtimestamp(round(stamp), datetime.timezone.utc)
+        if math.isnan(altitude):
+          altitude_values = ["", ""]
+        else:
+          altitude_values = ["%.1f" % abs(altitude), "Above Sea Level" if altitude >= 0 else "Below Sea Level"]
+        writer.writerow([path, "%.7f" % abs(latitude), "N" if latitude >= 0 else "S",
+                         "%.7f" % abs(longitude), "E" if longitude >= 0 else "W"] + altitude_values +
+                        [utc.strftime("%Y:%m:%d"), utc.strftime("%H:%M:%S")])
+
+    try:
+      cmd = ["-overwrite_original"] if overwrite_original else []
+      cmd += ["-csv=%s" % csv_file.name] + paths
+      failed |= failedPaths(runExiftool(cmd, pool), paths)
+    finally:
+      os.remove(csv_file.name)
+
+  return failed
+
+if __name__ == "__main__":
+  # Build a parser and parse the command line
+  parser = argparse.ArgumentParser(description = "Add the GPS position to photos, based on a GPS track and the time the photos were taken.")
+  parser.add_argument("-t", "--track", type = str, action = "append", required = True,
+                      help = "A GPX or NMEA file with the GPS track. This option can be used multiple times.")
+  parser.add_argument("-d", "--drift", type = str,
+                      help = "A CSV file with clock drift samples (see correctphotodrift.py) to correct the time of the photos with before looking up the position. The time in the photos isn't changed.")
+  parser.add_argument("-u", "--utc-offset", type = str,
+                      help = "The time zone of the camera clock, as an offset to UTC (e.g. +02:00). Defaults to the time zone of this computer.")
+  parser.add_argument("-g", "--max-gap", type = float, default = 300,
+                      help = "Don't interpolate between track points that are more than this number of seconds apart (defaults to 300).")
+  parser.add_argument("-n", "--dry-run", action = "store_true",
+                      help = "Don't alter any files, just print out the positions.")
+  parser.add_argument("-o", "--overwrite-original", action = "store_true",
+                      help = "Don't keep a copy of the original files (by default, Exiftool saves them with \"_original\" appended to the file name).")
+  cache_group = parser.add_mutually_exclusive_group()
+  cache_group.add_argument("--cache", type = str,
+                           help = "The file to cache the datetime metadata of the photos in. Defaults to the cache of correctphotodrift.py.")
+  cache_group.add_argument("--no-cache", action = "store_true",
+                           help = "Don't use the metadata cache.")
+  parser.add_argument("-i", "--ignore-reading",
+                      choices = MetaDataDateTime.known_tags,
+                      action = "append",
+                      help = "Ignore this tag for reading the datetime. This tag can be used multiple times.")
+  parser.add_argument("photo", type = str, nargs = "+", help = "The photo files to geotag.")
+  args = parser.parse_args()
+
+  # Check if exiftool is there
+  try:
+    status = subprocess.run(["exiftool", "-ver"], stdout = subprocess.PIPE)
+  except FileNotFoundError:
+    raise Exception("Please install Exiftool")
+  if status.returncode != 0:
+    raise Exception("Exiftool can't be run")
+
+  try:
+    utc_offset = parseUTCOffset(args.utc_offset) if args.utc_offset else None
+  except ValueError as e:
+    parser.error(str(e))
+
+  try:
+    track = readTrack(args.track)
+  except (OSError, ValueError, ElementTree.ParseError) as e:
+    sys.stderr.write("Couldn't read the track: %s\n" % e)
+    sys.exit(1)
+  if not len(track):
+    sys.stderr.write("The track doesn't contain any points\n")
+    sys.exit(1)
+
+  drift_model = DriftModel(readCSVFile(args.drift)) if args.drift else None
+
+  # The metadata cache is just an optimization, so carry on without it if that
+  # doesn't work out
+  cache = None
+  if not args.no_cache:
+    try:
+      cache = MetaDataCache(args.cache)
+    except (OSError, sqlite3.Error) as e:
+      sys.stderr.write("Not using the metadata cache: %s\n" % e)
+
+  failures = []
+  with ExifToolPool() as pool:
+    # Read the time of all photos in one batch, and look them all up in the
+    # track in a single pass
+    paths = []
+    stamps = []
+    for path, metadata in readMetaDataBatch(args.photo, args.ignore_reading or [], pool, cache = cache):
+      if not metadata or not metadata.dt:
+        sys.stderr.write("The date and time couldn't be extracted from %s\n" % path)
+        failures.append(path)
+        continue
+      try:
+        stamps.append(photoTimestamp(metadata, drift_model, utc_offset))
+      except Exception as e:
+        sys.stderr.write("The time of %s couldn't be corrected: %s\n" % (path, e))
+        failures.append(path)
+        continue
+      paths.append(path)
+
+    geotags = []
+    outside = []
+    for path, stamp, position in zip(paths, stamps, track.positions(stamps, args.max_gap)):
+      if position:
+        geotags.append((path, stamp, position))
+      else:
+        outside.append(path)
+
+    if args.dry_run:
+      for path, stamp, (latitude, longitude, altitude) in geotags:
+        print("%s: %.7f, %.7f%s" % (path, latitude, longitude, "" if math.isnan(altitude) else ", %.1f m" % altitude))
+    else:
+      failed = writeGPSBatch(geotags, pool, args.overwrite_original)
+      for path in sorted(failed):
+        sys.stderr.write("The position couldn't be written to %s\n" % path)
+      failures += sorted(failed)
+
+  if cache:
+    cache.close()
+
+  for path in outside:
+    print("%s: no position, the photo wasn't taken during the track" % path)
+  print("Geotagged %d of %d photos, %d outside of the track, %d failed" %
+        (len(geotags) - (0 if args.dry_run else len(failed)), len(args.photo), len(outside), len(failures)))
+
+  if failures:
+    sys.exit(1)
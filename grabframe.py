@@ -1,6 +1,21 @@
 #!/usr/bin/env python3
 
-import os.path, re, subprocess, sys
+import argparse, decimal, os, os.path, re, shutil, subprocess, sys, tempfile
+
+import instrument
+
+# The maximum number of frames to extract in a single FFmpeg run, to keep the
+# number of open output files in check
+MAX_FRAMES_PER_RUN = 64
+
+# If the next time stamp is more than this number of seconds further into the
+# video, it's faster to seek to it in a new FFmpeg run than to decode all
+# frames in between
+MAX_DECODE_GAP = 30
+
+# The index and time of a frame in the showinfo output. Frames without a time
+# stamp (with pts_time:NOPTS) don't match.
+RE_SHOWINFO = re.compile(r"\[Parsed_showinfo_\d+ @ [^\]]+\] n:\s*(\d+) pts:\s*\S+ pts_time:(-?[0-9.]+)")
    
 class TimeFormat:
   """ Class for storing and converting timestamps. """
@@ -49,24 +64,28 @@ class TimeFormat:
       ret_str += "%s" % self.s_sub
     
     return ret_str
+
+  def getSeconds(self):
+    """ Return the timestamp as a Decimal number of seconds. """
+
+    return decimal.Decimal(self.getSecFormat())
   
-  def getHMSFormat(self):
-    """ Return the timestamp formatted as HH:MM:SS """
-    
-    # Convert to hours, minutes, seconds
-    seconds = self.s
-    hours = seconds / (60 * 60)
-    seconds = seconds % (60 * 60)
-    minutes = seconds / 60
-    seconds = seconds % 60
-    
-    # Round subseconds to nearest second
-    if self.s_sub and float(self.s_sub) >= 0.5:
-      seconds += 1
-    
-    ret_str = "%02d:%02d:%02d" % (hours, minutes, seconds)
-    
-    return ret_str
+  def getShiftFormat(self):
+    """ Return the whole seconds of the timestamp formatted as H:MM:SS, without
+        rounding. The subseconds can be retrieved with getSubSecFormat(). """
+
+    minutes, seconds = divmod(self.s, 60)
+    hours, minutes   = divmod(minutes, 60)
+
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+  def getSubSecFormat(self):
+    """ Return the subseconds as a string of digits, as used by the Exif
+        SubSecTime tags, or None if there are no subseconds. """
+
+    if self.s_sub and self.s_sub != ".":
+      return self.s_sub[1:]
+    return None
     
 class JPGFileNameGenerator:
   """ Class for generating unique jpg file names using a sequence number that is
@@ -77,23 +96,177 @@ class JPGFileNameGenerator:
     self.seq = 0
   
   def get(self):
+    """ Return the next unused file name. The name is reserved, so it isn't
+        returned again even if the file hasn't been created yet. """
+
     candidate = "%s_%03d.jpg" % (self.base, self.seq)
     while os.path.exists(candidate):
       self.seq += 1
       candidate = "%s_%03d.jpg" % (self.base, self.seq)
+    self.seq += 1
     
     return candidate
-  
-def showHelp():
-  print("Save a frames from a video file to jpg with the correct timestamp")
-  print("\nUSAGE: %s VIDEO_FILE TIMESTAMP1 [TIMESTAMP2 TIMESTAMP3 ...]" % sys.argv[0])
-  print("Where time stamps can be formatted as [HH:]MM:SS[.sss] or SS[.sss] format (with one or two digits for the HH, MM and SS fields, and optional hour and subsecond fields.)")
-  print("\nThe files will be saved under the name of the video file combined with sequence number")
-  sys.exit(1)
-  
+
+def groupFrames(frames):
+  """ Sort the list of (TimeFormat, file name) tuples by time, and split it into
+      groups that can each be extracted efficiently by a single FFmpeg run. """
+
+  groups = []
+  for frame in sorted(frames, key = lambda frame: frame[0].getSeconds()):
+    if groups and len(groups[-1]) < MAX_FRAMES_PER_RUN and \
+       frame[0].getSeconds() - groups[-1][-1][0].getSeconds() <= MAX_DECODE_GAP:
+      groups[-1].append(frame)
+    else:
+      groups.append([frame])
+
+  return groups
+
+def grabFrames(video_file, frames):
+  """ Save the frames in the list of (TimeFormat, file name) tuples, sorted by
+      time, from the video_file with a single FFmpeg run. The video is seeked
+      to the first time stamp and decoded once, and a trim filter picks out
+      each frame for its own output file. Returns the FFmpeg log output. """
+
+  start = frames[0][0].getSeconds()
+
+  # Split the video into a branch for each frame. Each branch skips to its time
+  # stamp (relative to the seek point) and then passes on only a single frame.
+  if len(frames) == 1:
+    graph = "[0:v]"
+  else:
+    graph = "[0:v]split=%d%s;" % (len(frames), "".join("[s%d]" % i for i in range(len(frames))))
+  for i, (stamp, _) in enumerate(frames):
+    if len(frames) > 1:
+      graph += "[s%d]" % i
+    graph += "trim=start=%s,trim=end_frame=1[o%d];" % (stamp.getSeconds() - start, i)
+
+  ffmpeg_params = [
+    "ffmpeg",
+    "-ss", str(start),           # Seek the input to the first time stamp
+    "-accurate_seek",            # Don't round to the closes seek point, we want the exact frame
+    "-i", video_file,
+    "-filter_complex", graph[:-1],
+    "-loglevel", "24"]           # Log at warning level, since that is where critical errors for creating the jpg are reported
+  for i, (_, file_name) in enumerate(frames):
+    ffmpeg_params += ["-map", "[o%d]" % i, "-frames:v", "1", file_name]
+  ffmpeg_result = subprocess.run(ffmpeg_params, stderr = subprocess.PIPE)
+
+  return ffmpeg_result.stderr.decode("utf-8")
+
+def grabSelectedFrames(video_file, select_expr, generator):
+  """ Save all frames of the video_file for which the FFmpeg select filter
+      expression select_expr is true, decoding the video only once. The files
+      are named by the JPGFileNameGenerator generator.
+      Returns a list of (TimeFormat, file name) tuples of the saved frames,
+      and the FFmpeg log output. """
+
+  # Let FFmpeg write the frames to a temporary directory, and use the showinfo
+  # filter to find out the time of each frame
+  tmp_dir = tempfile.mkdtemp(dir = os.path.dirname(os.path.abspath(video_file)))
+  try:
+    ffmpeg_params = [
+      "ffmpeg",
+      "-i", video_file,
+      "-vf", "select='%s',showinfo" % select_expr,
+      "-vsync", "passthrough",     # Write each selected frame exactly once
+      "-hide_banner", "-nostats",
+      "-loglevel", "info",         # The showinfo output is logged at info level
+      os.path.join(tmp_dir, "%08d.jpg")]
+    ffmpeg_result = subprocess.run(ffmpeg_params, stderr = subprocess.PIPE)
+    ffmpeg_output = ffmpeg_result.stderr.decode("utf-8", "replace")
+    with instrument.span("parse showinfo", "parse") as timed:
+      times = sorted((int(n), time) for n, time in RE_SHOWINFO.findall(ffmpeg_output))
+      timed.bytes_in = len(ffmpeg_output)
+
+    frames = []
+    with instrument.span("rename frames", "io", frames = len(times)):
+      for n, time in times:
+        # Showinfo counts the selected frames from 0, the files are numbered
+        # from 1. Frames without a time are left in the temporary directory.
+        tmp_name = os.path.join(tmp_dir, "%08d.jpg" % (n + 1))
+        if not os.path.exists(tmp_name):
+          continue
+        # Frames before the start of the timeline are shown at its start
+        if time.startswith("-"):
+          time = "0"
+        file_name = generator.get()
+        os.rename(tmp_name, file_name)
+        frames.append((TimeFormat(time), file_name))
+  finally:
+    shutil.rmtree(tmp_dir, ignore_errors = True)
+
+  return frames, ffmpeg_output
+
+def runExiftoolArgFile(args):
+  """ Run Exiftool with the list of arguments written to an argument file, so
+      the command line length doesn't limit the number of files. Returns the
+      subprocess.CompletedProcess, with the stderr output. """
+
+  with instrument.span("write argfile", "io") as timed, \
+       tempfile.NamedTemporaryFile("w", suffix = ".args", delete = False, encoding = "utf-8") as arg_file:
+    timed.bytes_out = arg_file.write("\n".join(args) + "\n")
+  try:
+    return subprocess.run(["exiftool", "-@", arg_file.name], stderr = subprocess.PIPE)
+  finally:
+    os.remove(arg_file.name)
+
+def stampFrames(video_file, frames):
+  """ Copy the metadata of the video_file to all frames in the list of
+      (TimeFormat, file name) tuples, with the time stamps shifted to the
+      point where the frame was grabbed (including subseconds). All frames are
+      processed in a single Exiftool run, with one command for each frame, so
+      each file is written only once. Returns the set of file names that
+      couldn't be stamped. """
+
+  args = []
+  for stamp, file_name in frames:
+    args += ["-q", "-overwrite_original", "-tagsfromfile", video_file, "-all"]
+
+    # Override the copied date tags with shifted ones
+    for tag in ["DateTimeOriginal", "CreateDate", "ModifyDate"]:
+      args.append("-%s<${%s;ShiftTime(\"%s\")}" % (tag, tag, stamp.getShiftFormat()))
+    sub_sec = stamp.getSubSecFormat()
+    if sub_sec:
+      for tag in ["SubSecTimeOriginal", "SubSecTimeDigitized", "SubSecTime"]:
+        args.append("-%s=%s" % (tag, sub_sec))
+
+    args += [file_name, "-execute"]
+  result = runExiftoolArgFile(args)
+
+  # Exiftool reports failures as "Error: message - file"
+  file_names = [file_name for _, file_name in frames]
+  failed = set()
+  for line in result.stderr.decode("utf-8", "replace").splitlines():
+    if line.startswith("Error"):
+      failed |= {file_name for file_name in file_names if line.endswith(" - %s" % file_name)}
+  if result.returncode != 0 and not failed:
+    failed = set(file_names)
+  if failed:
+    sys.stderr.write("Couldn't copy the metadata to: %s\n" % ", ".join(sorted(failed)))
+
+  return failed
+
 if __name__ == "__main__":
-  if len(sys.argv) < 3:
-    showHelp()
+  parser = argparse.ArgumentParser(description = "Save frames from a video file to jpg with the correct timestamp. The files will be saved under the name of the video file combined with sequence number.")
+  mode_group = parser.add_mutually_exclusive_group()
+  mode_group.add_argument("-i", "--interval", type = float,
+                          help = "Instead of at the given time stamps, save a frame every INTERVAL seconds.")
+  mode_group.add_argument("-s", "--scene", type = float, metavar = "THRESHOLD",
+                          help = "Instead of at the given time stamps, save a frame at every scene change. The THRESHOLD is between 0 and 1, where lower values detect more scene changes (0.3 is a good start).")
+  parser.add_argument("video_file", type = str, help = "The video file to grab the frames from")
+  parser.add_argument("time_stamp", type = str, nargs = "*",
+                      help = "The time stamps of the frames, formatted as [HH:]MM:SS[.sss] or SS[.sss] format (with one or two digits for the HH, MM and SS fields, and optional hour and subsecond fields.)")
+  instrument.addArguments(parser)
+  args = parser.parse_args()
+  instrument.enableFromArgs(args)
+
+  if args.interval is not None or args.scene is not None:
+    if args.time_stamp:
+      parser.error("time stamps can't be combined with the --interval or --scene options")
+    if args.interval is not None and args.interval <= 0:
+      parser.error("the interval should be larger than 0")
+  elif not args.time_stamp:
+    parser.error("specify the time stamps, or use the --interval or --scene options")
   
   # Check if FFmpeg and Exiftool are installed
   try:
@@ -108,63 +281,56 @@ if __name__ == "__main__":
     sys.exit(1)
   
   # Check if the video file is there
-  video_file = sys.argv[1]
+  video_file = args.video_file
   if not (os.path.exists(video_file) and os.path.isfile(video_file)):
-    sys.stderr.write("ERROR: file \"%s\" does not exist" % video_file)
-    showHelp()
-  
-  # Collect all time stamps
-  stamps = []
-  for time_stamp in sys.argv[2:]:
-    try:
-      stamps.append(TimeFormat(time_stamp))
-    except TimeFormat.TimeFormatException as e:
-      sys.stdout.write("ERROR: %s\n\n" % str(e))
-      showHelp()
-  
-  # Process all time stamps
+    parser.error("file \"%s\" does not exist" % video_file)
+
   generator = JPGFileNameGenerator(video_file)
-  for stamp in stamps:
-    file_name = generator.get()
-    
-    # Cut out the frame
-    ffmpeg_params = [
-      "ffmpeg",
-      "-ss", stamp.getSecFormat(), # Seek the input to the specified time stamp
-      "-accurate_seek",            # Don't round to the closes seek point, we want the exact frame
-      "-i", video_file,
-      "-frames:v", "1",            # We want a single vide frame
-      "-loglevel", "24",           # Log at warning level, since that is where critical errors for creating the jpg are reported
-      file_name]
-    ffmpeg_result = subprocess.run(ffmpeg_params, stderr = subprocess.PIPE)
-    
-    # FFmpeg does not throw a fatal error or exit with a non-zero return code
-    # when the operation fails, so we have to check for the existence of the
-    # jpg file to determine success.
-    if not os.path.exists(file_name):
-      sys.stderr.write("It seems like the operation failed for timestamp \"%s\"! " % stamp.getOriginal())
-      sys.stderr.write("Here's the output of FFmpeg:\n=====\n%s\n=====\n" % ffmpeg_result.stderr.decode("utf-8"))
+  grabbed = []
+
+  if args.interval is not None or args.scene is not None:
+    if args.interval is not None:
+      # Select the first frame at or after every multiple of the interval
+      select_expr = "isnan(prev_selected_t)+gte(floor(t/%f),floor(prev_selected_t/%f)+1)" % (args.interval, args.interval)
     else:
-      print("Time stamp \"%s\" is saved as \"%s\"" % (stamp.getOriginal(), file_name))
+      select_expr = "gt(scene,%f)" % args.scene
+    grabbed, ffmpeg_output = grabSelectedFrames(video_file, select_expr, generator)
+    if not grabbed:
+      sys.stderr.write("It seems like no frames were saved! ")
+      sys.stderr.write("Here's the output of FFmpeg:\n=====\n%s\n=====\n" % ffmpeg_output)
+    for stamp, file_name in grabbed:
+      print("Frame at %s seconds is saved as \"%s\"" % (stamp.getOriginal(), file_name))
+
+  else:
+    # Collect all time stamps
+    stamps = []
+    for time_stamp in args.time_stamp:
+      try:
+        stamps.append(TimeFormat(time_stamp))
+      except TimeFormat.TimeFormatException as e:
+        parser.error(str(e))
+    
+    # Name the files in the order of the time stamps on the command line, but
+    # extract them in order of time, so the video needs to be decoded only once
+    frames = [(stamp, generator.get()) for stamp in stamps]
+    saved = set()
+    for group in groupFrames(frames):
+      ffmpeg_output = grabFrames(video_file, group)
       
-      # Copy the video metadata to the jpeg file
-      exiftool_copy_params = [
-        "exiftool",
-        "-q",
-        "-overwrite_original",
-        "-tagsfromfile", video_file,
-        file_name]
-      exiftool_copy_result = subprocess.run(exiftool_copy_params)
-      if exiftool_copy_result.returncode != 0:
-        sys.stderr.write("Couldn't copy the metadata!")
-      else:
-        # Shift the time stamp to the point where the frame was grabbed
-        exiftool_shift_params = [
-          "exiftool",
-          "-q",
-          "-overwrite_original",
-          "-alldates+=%s" % stamp.getHMSFormat(),
-          file_name]
-        exiftool_shift_result = subprocess.run(exiftool_shift_params)
-        if exiftool_shift_result.returncode != 0:
-          sys.stderr("Couldn't update the time stamp!")
+      # FFmpeg does not throw a fatal error or exit with a non-zero return code
+      # when the operation fails, so we have to check for the existence of the
+      # jpg file to determine success.
+      for stamp, file_name in group:
+        if not os.path.exists(file_name):
+          sys.stderr.write("It seems like the operation failed for timestamp \"%s\"! " % stamp.getOriginal())
+          sys.stderr.write("Here's the output of FFmpeg:\n=====\n%s\n=====\n" % ffmpeg_output)
+        else:
+          saved.add(file_name)
+
+    grabbed = [(stamp, file_name) for stamp, file_name in frames if file_name in saved]
+    for stamp, file_name in grabbed:
+      print("Time stamp \"%s\" is saved as \"%s\"" % (stamp.getOriginal(), file_name))
+
+  # Copy the video metadata to the jpeg files, with the time of each frame
+  if grabbed:
+    stampFrames(video_file, grabbed)
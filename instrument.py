@@ -0,0 +1,158 @@
+""" Opt-in instrumentation for the scripts in this collection. When enabled
+    (with the --stats or --trace options), the time spent in named spans of
+    code (external commands, file I/O, parsing) is recorded, together with the
+    number of bytes that went in and out. When the script exits, a summary per
+    span is written to stderr, and/or a timeline in the Chrome trace event
+    format is written to a file (open it in chrome://tracing or
+    https://ui.perfetto.dev). When not enabled, the hooks do nothing. """
+
+import atexit, collections, json, os, subprocess, sys, threading, time
+
+_enabled     = False
+_show_stats  = False
+_trace_file  = None
+_lock        = threading.Lock()
+_events      = []
+_thread_ids  = {}
+_start       = time.perf_counter()
+_original_run = subprocess.run
+
+# The [count, seconds, bytes in, bytes out] for each (category, name)
+_stats = collections.defaultdict(lambda: [0, 0.0, 0, 0])
+
+class Span:
+  """ A timed section of code, used as a context manager. Set bytes_in and
+      bytes_out to count the data read and written in it. """
+
+  def __init__(self, name, category, args):
+    self.name      = name
+    self.category  = category
+    self.args      = args
+    self.bytes_in  = 0
+    self.bytes_out = 0
+
+  def __enter__(self):
+    self._start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    _record(self, time.perf_counter())
+    return False
+
+class _NullSpan:
+  """ Stands in for a Span when the instrumentation isn't enabled. """
+
+  bytes_in  = 0
+  bytes_out = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    return False
+
+def span(name, category = "stage", **args):
+  """ Return a context manager that records the time spent in it under name
+      and category. The keyword args are added to the trace event. """
+
+  if not _enabled:
+    return _NullSpan()
+  return Span(name, category, args)
+
+def _record(timed, end):
+  """ Add the finished Span timed to the statistics and the trace. """
+
+  with _lock:
+    stats = _stats[(timed.category, timed.name)]
+    stats[0] += 1
+    stats[1] += end - timed._start
+    stats[2] += timed.bytes_in
+    stats[3] += timed.bytes_out
+
+    if _trace_file:
+      event = {"name": timed.name, "cat": timed.category, "ph": "X",
+               "ts": round((timed._start - _start) * 1e6, 1), "dur": round((end - timed._start) * 1e6, 1),
+               "pid": os.getpid(), "tid": _thread_ids.setdefault(threading.get_ident(), len(_thread_ids) + 1)}
+      args = dict(timed.args)
+      if timed.bytes_in:
+        args["bytes_in"] = timed.bytes_in
+      if timed.bytes_out:
+        args["bytes_out"] = timed.bytes_out
+      if args:
+        event["args"] = args
+      _events.append(event)
+
+def _timedRun(*popenargs, **kwargs):
+  """ Replacement for subprocess.run() that records each command as a span
+      named after the program, counting the input and captured output. """
+
+  cmd = popenargs[0] if popenargs else kwargs.get("args")
+  if isinstance(cmd, (list, tuple)):
+    program, command = os.path.basename(str(cmd[0])), " ".join(str(arg) for arg in cmd)
+  else:
+    program, command = os.path.basename(str(cmd).split(" ", 1)[0]), str(cmd)
+
+  with span(program, "subprocess", command = command[:200]) as timed:
+    result = _original_run(*popenargs, **kwargs)
+    if isinstance(kwargs.get("input"), (bytes, str)):
+      timed.bytes_out = len(kwargs["input"])
+    for output in (result.stdout, result.stderr):
+      if isinstance(output, (bytes, str)):
+        timed.bytes_in += len(output)
+  return result
+
+def enable(stats = False, trace_file = None):
+  """ Start recording if stats is True or a trace_file is given. All
+      subprocess.run() calls are recorded from now on. """
+
+  global _enabled, _show_stats, _trace_file
+
+  if not (stats or trace_file) or _enabled:
+    return
+  _enabled    = True
+  _show_stats = stats
+  _trace_file = trace_file
+  subprocess.run = _timedRun
+  atexit.register(_report)
+
+def addArguments(parser):
+  """ Add the --stats and --trace options to the argparse parser. """
+
+  parser.add_argument("--stats", action = "store_true",
+                      help = "Print a summary of where the time was spent to standard error when done.")
+  parser.add_argument("--trace", type = str, metavar = "FILE",
+                      help = "Write a timeline of where the time was spent to FILE, in Chrome trace format (open it in chrome://tracing or https://ui.perfetto.dev).")
+
+def enableFromArgs(args):
+  """ Enable the instrumentation according to the options added by
+      addArguments(). """
+
+  enable(args.stats, args.trace)
+
+def _report():
+  """ Write the summary and the trace, as requested. """
+
+  wall = time.perf_counter() - _start
+  with _lock:
+    stats = sorted(_stats.items(), key = lambda item: -item[1][1])
+    events = list(_events)
+
+  if _show_stats:
+    # Spans can be nested and run in parallel, so the percentages don't need
+    # to add up to 100
+    sys.stderr.write("\n%-12s %-32s %8s %10s %7s %10s %10s %10s\n" %
+                     ("category", "name", "count", "total s", "% wall", "mean ms", "MB in", "MB out"))
+    for (category, name), (count, seconds, bytes_in, bytes_out) in stats:
+      sys.stderr.write("%-12s %-32s %8d %10.3f %7.1f %10.3f %10.2f %10.2f\n" %
+                       (category, name[:32], count, seconds, 100 * seconds / wall if wall else 0,
+                        1000 * seconds / count, bytes_in / 1e6, bytes_out / 1e6))
+    sys.stderr.write("Total wall time: %.3f s\n" % wall)
+
+  if _trace_file:
+    events.insert(0, {"name": "process_name", "ph": "M", "pid": os.getpid(),
+                      "args": {"name": os.path.basename(sys.argv[0])}})
+    try:
+      with open(_trace_file, "w") as out_file:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, out_file)
+    except OSError as e:
+      sys.stderr.write("Couldn't write the trace: %s\n" % e)
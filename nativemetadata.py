@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+
+""" Read the datetime tags of common JPEG and MP4/MOV files without Exiftool,
+    by parsing the file headers directly. Only the tags that correctphotodrift.py
+    knows about are read, and only when we're sure to get the same result as
+    Exiftool. For anything else, readDateTimeTags() returns None, so the caller
+    can fall back to Exiftool.
+
+    When run as a script, the results for the given files are compared to what
+    Exiftool reports. With --fixtures, files that should and shouldn't be read
+    natively are generated first (see benchmark.py) and checked. """
+
+import datetime, json, mmap, re, struct, subprocess, sys
+
+# The Exif tag IDs of the tags we're interested in
+EXIF_IFD_POINTER      = 0x8769
+EXIF_DATETIMEORIGINAL = 0x9003
+EXIF_CREATEDATE       = 0x9004
+
+RE_EXIF_DATETIME = re.compile(rb"^(\d{4}):(\d{2}):(\d{2}) (\d{2}):(\d{2}):(\d{2})\x00*$")
+
+# QuickTime stores times as seconds since 1904-01-01
+QUICKTIME_EPOCH_OFFSET = (66 * 365 + 17) * 24 * 60 * 60
+
+# ISO base media boxes that are known not to contain any of our datetime tags,
+# at the levels of the box tree where we expect them. If we find anything else
+# (XMP, maker specific boxes with Exif data, etc.), Exiftool might report a
+# different value than we would.
+SAFE_TOP_LEVEL_BOXES = {b"ftyp", b"moov", b"mdat", b"free", b"skip", b"wide", b"pdin"}
+SAFE_MOOV_BOXES      = {b"mvhd", b"trak", b"iods", b"udta", b"meta", b"free", b"skip"}
+SAFE_TRAK_BOXES      = {b"tkhd", b"mdia", b"edts", b"tref", b"tapt", b"udta", b"free", b"skip"}
+SAFE_UDTA_BOXES      = {b"\xa9xyz", b"\xa9too", b"\xa9swr", b"\xa9enc", b"\xa9fmt", b"\xa9mak", b"\xa9mod",
+                        b"\xa9nam", b"\xa9cmt", b"\xa9inf", b"\xa9des", b"meta", b"name", b"hnti", b"hinf",
+                        b"free", b"skip"}
+
+# Brands of ISO base media files that aren't plain movies (HEIF images, Canon
+# raw files), which Exiftool reads differently
+UNSUPPORTED_BRANDS = {b"heic", b"heix", b"heim", b"heis", b"hevc", b"mif1", b"msf1", b"avif", b"crx "}
+
+class UnsupportedFile(Exception):
+  """ Raised internally when a file contains something we can't handle. """
+  pass
+
+def readDateTimeTags(path):
+  """ Read the datetime tags of the file at path. Returns a dict mapping the tag
+      names (as Exiftool calls them) to datetime.datetime objects, or None if
+      the file format isn't supported and Exiftool should be used instead. """
+
+  try:
+    with open(path, "rb") as in_file:
+      with mmap.mmap(in_file.fileno(), 0, access = mmap.ACCESS_READ) as data:
+        if data[:2] == b"\xff\xd8":
+          return _readJPEG(data)
+        if data[4:8] in (b"ftyp", b"moov", b"mdat", b"wide", b"free", b"skip"):
+          return _readISOBMFF(data)
+  except (OSError, ValueError, IndexError, struct.error, UnsupportedFile):
+    # ValueError is raised for empty files that can't be mapped, IndexError
+    # for truncated files
+    pass
+
+  return None
+
+def _readJPEG(data):
+  """ Read DateTimeOriginal and CreateDate from the Exif segment of a JPEG
+      file. """
+
+  # Walk the segments up to the start of the image data to find the Exif data
+  pos = 2
+  tiff_start = None
+  while pos + 4 <= len(data):
+    if data[pos] != 0xff:
+      raise UnsupportedFile()
+    marker = data[pos + 1]
+    if marker == 0xff:                         # Fill byte
+      pos += 1
+      continue
+    if marker == 0x01 or 0xd0 <= marker <= 0xd8: # Segments without length
+      pos += 2
+      continue
+    if marker in (0xd9, 0xda):                 # End of image, start of scan
+      break
+
+    length = struct.unpack(">H", data[pos + 2:pos + 4])[0]
+    if marker == 0xe1 and data[pos + 4:pos + 10] == b"Exif\x00\x00" and tiff_start is None:
+      tiff_start = pos + 10
+    pos += 2 + length
+
+  if tiff_start is None:
+    raise UnsupportedFile()
+
+  tags = _readTIFF(data, tiff_start)
+
+  # Without both tags, Exiftool might find them somewhere else (XMP, trailers)
+  if set(tags) != {"DateTimeOriginal", "CreateDate"}:
+    raise UnsupportedFile()
+
+  return tags
+
+def _readTIFF(data, start):
+  """ Read the datetime tags from the Exif IFD of the TIFF structure at offset
+      start. """
+
+  byte_order = {b"II": "<", b"MM": ">"}.get(bytes(data[start:start + 2]))
+  if not byte_order or struct.unpack(byte_order + "H", data[start + 2:start + 4])[0] != 42:
+    raise UnsupportedFile()
+
+  def readIFD(offset):
+    """ Return a dict of tag ID -> (type, count, value/offset bytes). """
+    pos = start + offset
+    count = struct.unpack(byte_order + "H", data[pos:pos + 2])[0]
+    entries = {}
+    for i in range(count):
+      entry = pos + 2 + i * 12
+      tag_id, tag_type, tag_count = struct.unpack(byte_order + "HHI", data[entry:entry + 8])
+      entries[tag_id] = (tag_type, tag_count, data[entry + 8:entry + 12])
+    return entries
+
+  ifd0 = readIFD(struct.unpack(byte_order + "I", data[start + 4:start + 8])[0])
+  if EXIF_IFD_POINTER not in ifd0:
+    return {}
+  exif_ifd = readIFD(struct.unpack(byte_order + "I", ifd0[EXIF_IFD_POINTER][2])[0])
+
+  tags = {}
+  for tag_id, name in ((EXIF_DATETIMEORIGINAL, "DateTimeOriginal"), (EXIF_CREATEDATE, "CreateDate")):
+    if tag_id not in exif_ifd:
+      continue
+    tag_type, tag_count, value = exif_ifd[tag_id]
+    if tag_type != 2: # ASCII
+      raise UnsupportedFile()
+    if tag_count > 4:
+      offset = start + struct.unpack(byte_order + "I", value)[0]
+      value = data[offset:offset + tag_count]
+
+    # Exiftool would print anything that isn't a plain date and time as it is
+    match = RE_EXIF_DATETIME.match(bytes(value))
+    if not match:
+      raise UnsupportedFile()
+    tags[name] = datetime.datetime(*[int(group) for group in match.groups()])
+
+  return tags
+
+def _iterBoxes(data, start, end):
+  """ Iterate over the ISO base media boxes between offset start and end,
+      yielding (type, content start, content end) tuples. """
+
+  pos = start
+  while pos + 8 <= end:
+    size, box_type = struct.unpack(">I4s", data[pos:pos + 8])
+    header = 8
+    if size == 1:
+      size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+      header = 16
+    elif size == 0:
+      size = end - pos
+    if size < header or pos + size > end:
+      raise UnsupportedFile()
+    yield box_type, pos + header, pos + size
+    pos += size
+
+def _readQuickTimeTimes(data, start, end):
+  """ Read the creation and modification time from a mvhd, tkhd or mdhd box
+      with content from start to end. """
+
+  if end - start < 12:
+    raise UnsupportedFile()
+  version = data[start]
+  if version == 0:
+    create, modify = struct.unpack(">II", data[start + 4:start + 12])
+  elif version == 1 and end - start >= 20:
+    create, modify = struct.unpack(">QQ", data[start + 4:start + 20])
+  else:
+    raise UnsupportedFile()
+
+  # Exiftool prints zero times as zeros, and interprets times before 1970 in a
+  # special way
+  times = []
+  for value in (create, modify):
+    if value < QUICKTIME_EPOCH_OFFSET:
+      raise UnsupportedFile()
+    times.append(datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds = value - QUICKTIME_EPOCH_OFFSET))
+  return times
+
+def _readISOBMFF(data):
+  """ Read CreateDate from the movie header, and TrackCreateDate,
+      TrackModifyDate, MediaCreateDate and MediaModifyDate from the track and
+      media headers of an MP4 or MOV file. Like Exiftool without the
+      QuickTimeUTC option, the times are taken as local time. """
+
+  tags = {}
+  track_tags = []
+  found_moov = False
+  for box_type, start, end in _iterBoxes(data, 0, len(data)):
+    if box_type not in SAFE_TOP_LEVEL_BOXES:
+      raise UnsupportedFile()
+
+    if box_type == b"ftyp":
+      brands = {data[start:start + 4]}
+      for pos in range(start + 8, end - 3, 4):
+        brands.add(data[pos:pos + 4])
+      if brands & UNSUPPORTED_BRANDS:
+        raise UnsupportedFile()
+
+    elif box_type == b"moov":
+      if found_moov:
+        raise UnsupportedFile()
+      found_moov = True
+
+      for moov_type, moov_start, moov_end in _iterBoxes(data, start, end):
+        if moov_type not in SAFE_MOOV_BOXES:
+          raise UnsupportedFile()
+        if moov_type == b"mvhd":
+          tags["CreateDate"] = _readQuickTimeTimes(data, moov_start, moov_end)[0]
+        elif moov_type == b"udta":
+          _checkUserData(data, moov_start, moov_end)
+        elif moov_type == b"trak":
+          track_tags.append(_readTrack(data, moov_start, moov_end))
+
+  if not found_moov or "CreateDate" not in tags or not track_tags:
+    raise UnsupportedFile()
+
+  # Exiftool reports only one of the values if there are multiple tracks, so
+  # we can only be sure about the values if all tracks agree
+  for track in track_tags[1:]:
+    if track != track_tags[0]:
+      raise UnsupportedFile()
+  tags.update(track_tags[0])
+
+  return tags
+
+def _readTrack(data, start, end):
+  """ Read the datetime tags from the tkhd and mdhd boxes of a trak box. """
+
+  tags = {}
+  for box_type, box_start, box_end in _iterBoxes(data, start, end):
+    if box_type not in SAFE_TRAK_BOXES:
+      raise UnsupportedFile()
+    if box_type == b"tkhd":
+      tags["TrackCreateDate"], tags["TrackModifyDate"] = _readQuickTimeTimes(data, box_start, box_end)
+    elif box_type == b"udta":
+      _checkUserData(data, box_start, box_end)
+    elif box_type == b"mdia":
+      for mdia_type, mdia_start, mdia_end in _iterBoxes(data, box_start, box_end):
+        if mdia_type == b"mdhd":
+          tags["MediaCreateDate"], tags["MediaModifyDate"] = _readQuickTimeTimes(data, mdia_start, mdia_end)
+
+  if len(tags) != 4:
+    raise UnsupportedFile()
+
+  return tags
+
+def _checkUserData(data, start, end):
+  """ Make sure a udta box doesn't contain anything that Exiftool might read a
+      datetime tag from. """
+
+  for box_type, _, _ in _iterBoxes(data, start, end):
+    if box_type not in SAFE_UDTA_BOXES:
+      raise UnsupportedFile()
+
+def compareWithExiftool(paths, supported = None):
+  """ Print how the datetime tags read from the files in the list of paths
+      compare to what Exiftool reports. If supported is given, it maps the
+      paths to whether they should be read natively or left to Exiftool, and
+      that is checked as well. Returns the number of files that don't match. """
+
+  tag_names = ["DateTimeOriginal", "CreateDate", "MediaCreateDate", "MediaModifyDate", "TrackCreateDate", "TrackModifyDate"]
+  dt_format = "%Y-%m-%d %H:%M:%S"
+
+  cmd = ["exiftool", "-json", "-d", dt_format] + ["-%s" % tag for tag in tag_names] + paths
+  result = subprocess.run(cmd, stdout = subprocess.PIPE)
+  exiftool_values = {entry.pop("SourceFile"): entry for entry in json.loads(result.stdout.decode("utf-8") or "[]")}
+
+  mismatches = 0
+  for path in paths:
+    native = readDateTimeTags(path)
+    if native is None:
+      if supported and supported[path]:
+        mismatches += 1
+        print("%s: MISMATCH, should be supported but Exiftool is used" % path)
+      else:
+        print("%s: not supported, Exiftool is used" % path)
+      continue
+    if supported and not supported[path]:
+      mismatches += 1
+      print("%s: MISMATCH, should be left to Exiftool but is read natively" % path)
+      continue
+
+    native = {tag: value.strftime(dt_format) for tag, value in native.items()}
+    expected = {tag: str(value) for tag, value in exiftool_values.get(path, {}).items()}
+    if native == expected:
+      print("%s: OK" % path)
+    else:
+      mismatches += 1
+      print("%s: MISMATCH\n  native:   %s\n  exiftool: %s" % (path, native, expected))
+
+  return mismatches
+
+if __name__ == "__main__":
+  if len(sys.argv) < 2 or (sys.argv[1] == "--fixtures" and len(sys.argv) != 3):
+    print("Compare the datetime tags read without Exiftool to the values Exiftool reports")
+    print("\nUSAGE: %s FILE1 [FILE2 FILE3 ...]" % sys.argv[0])
+    print("       %s --fixtures DIR" % sys.argv[0])
+    print("\nWith --fixtures, JPEG, MP4 and MOV files with and without the supported")
+    print("metadata are generated in DIR (with FFmpeg and Exiftool) and checked.")
+    sys.exit(1)
+
+  if sys.argv[1] == "--fixtures":
+    import benchmark
+    try:
+      fixtures = benchmark.Corpus(sys.argv[2]).metadataFixtures()
+    except (benchmark.BenchmarkException, OSError) as e:
+      print("Couldn't generate the fixtures: %s" % e)
+      sys.exit(1)
+    mismatches = compareWithExiftool([path for path, _ in fixtures], dict(fixtures))
+  else:
+    mismatches = compareWithExiftool(sys.argv[1:])
+
+  sys.exit(1 if mismatches else 0)
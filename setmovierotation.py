@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+
+""" Set the rotation flag of movie files. The flag is the display matrix in the
+    track header of the video tracks, which is patched in place if possible.
+    Otherwise the movie is remuxed with FFmpeg into a temporary file that
+    replaces the original when done, so the original is never lost. """
+
+import argparse, collections, concurrent.futures, mmap, os, shutil, struct, subprocess, sys, tempfile
+
+MOVIE_EXTENSIONS = (".mp4", ".mov", ".m4v", ".3gp")
+
+class RotationException(Exception):
+    pass
+
+def displayMatrix(degrees, width, height):
+    """ Build the display matrix for the rotation, the same way FFmpeg does when
+        writing an MP4 file. The matrix is given as nine 32 bit numbers; the
+        last one in 2.30 format, the others in 16.16 format. """
+
+    a, b, c, d, x, y = {0:   (1, 0, 0, 1, 0, 0),
+                        90:  (0, 1, -1, 0, height, 0),
+                        180: (-1, 0, 0, -1, width, height),
+                        270: (0, -1, 1, 0, 0, width)}[degrees]
+    return struct.pack(">9i", a << 16, b << 16, 0, c << 16, d << 16, 0, x << 16, y << 16, 1 << 30)
+
+def iterBoxes(data, start, end):
+    """ Iterate over the boxes between offset start and end, yielding
+        (type, content start, content end) tuples. """
+
+    pos = start
+    while pos + 8 <= end:
+        size, box_type = struct.unpack(">I4s", data[pos:pos + 8])
+        header = 8
+        if size == 1:
+            size = struct.unpack(">Q", data[pos + 8:pos + 16])[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise RotationException("Invalid box structure")
+        yield box_type, pos + header, pos + size
+        pos += size
+
+def findVideoMatrices(movie_file):
+    """ Find the display matrices of the video tracks of the movie. Returns a
+        list of (offset, width, height) tuples, where offset is the position of
+        the matrix in the file. Raises a RotationException if the file can't be
+        patched in place. """
+
+    with open(movie_file, "rb") as movie:
+        if os.fstat(movie.fileno()).st_size < 8:
+            raise RotationException("File is too small")
+        with mmap.mmap(movie.fileno(), 0, access = mmap.ACCESS_READ) as data:
+            matrices = []
+            found_moov = False
+            for box_type, start, end in iterBoxes(data, 0, len(data)):
+                if box_type != b"moov":
+                    continue
+                if found_moov:
+                    raise RotationException("Multiple movie boxes")
+                found_moov = True
+
+                for trak_type, trak_start, trak_end in iterBoxes(data, start, end):
+                    if trak_type != b"trak":
+                        continue
+
+                    tkhd = None
+                    handler = None
+                    for box_type, box_start, box_end in iterBoxes(data, trak_start, trak_end):
+                        if box_type == b"tkhd":
+                            tkhd = (box_start, box_end)
+                        elif box_type == b"mdia":
+                            for mdia_type, mdia_start, mdia_end in iterBoxes(data, box_start, box_end):
+                                if mdia_type == b"hdlr" and mdia_end - mdia_start >= 12:
+                                    handler = data[mdia_start + 8:mdia_start + 12]
+
+                    if handler != b"vide":
+                        continue
+                    if tkhd is None:
+                        raise RotationException("Video track without header")
+
+                    # The matrix follows the times, track ID and duration (which
+                    # are larger in version 1), and some reserved fields. The
+                    # width and height in 16.16 format come after it.
+                    tkhd_start, tkhd_end = tkhd
+                    version = data[tkhd_start]
+                    if version not in (0, 1):
+                        raise RotationException("Unknown track header version")
+                    matrix_pos = tkhd_start + (40 if version == 0 else 52)
+                    if matrix_pos + 44 > tkhd_end:
+                        raise RotationException("Track header is too small")
+                    width, height = struct.unpack(">II", data[matrix_pos + 36:matrix_pos + 44])
+                    matrices.append((matrix_pos, width >> 16, height >> 16))
+
+            if not found_moov:
+                raise RotationException("No movie box found")
+            if not matrices:
+                raise RotationException("No video track found")
+            return matrices
+
+def patchRotation(movie_file, degrees):
+    """ Overwrite the display matrices of the video tracks in place. Only a few
+        bytes per track are written, so the file is never left in a state that
+        can't be read. """
+
+    matrices = findVideoMatrices(movie_file)
+    fd = os.open(movie_file, os.O_WRONLY)
+    try:
+        for offset, width, height in matrices:
+            os.pwrite(fd, displayMatrix(degrees, width, height), offset)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def remuxRotation(movie_file, degrees):
+    """ Set the rotation by remuxing the movie with FFmpeg into a temporary file
+        in the same directory, which then replaces the original. """
+
+    movie_dir, movie_name = os.path.split(os.path.abspath(movie_file))
+    fd, temp_file = tempfile.mkstemp(dir = movie_dir, prefix = "." + movie_name + ".",
+                                     suffix = os.path.splitext(movie_name)[1])
+    os.close(fd)
+    try:
+        # The "-map_metadata 0" flag is needed to copy over all metadata, this
+        # isn't done by default (anymore)
+        result = subprocess.run(["ffmpeg", "-y", "-nostdin", "-loglevel", "8", "-i", movie_file,
+                                 "-c", "copy", "-map_metadata", "0",
+                                 "-metadata:s:v", "rotate=%d" % degrees, temp_file],
+                                stdout = subprocess.PIPE, stderr = subprocess.PIPE)
+        if result.returncode != 0:
+            raise RotationException(result.stderr.decode("utf-8", "replace").strip() or "FFmpeg failed")
+        shutil.copymode(movie_file, temp_file)
+        os.replace(temp_file, movie_file)
+    except BaseException:
+        if os.path.exists(temp_file):
+            os.remove(temp_file)
+        raise
+
+def findMovies(paths):
+    """ Generate the files in the list of paths, and all movie files in the
+        directories in it (recursively). """
+
+    for path in paths:
+        if os.path.isdir(path):
+            for dir_path, dir_names, file_names in os.walk(path):
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    if os.path.splitext(file_name)[1].lower() in MOVIE_EXTENSIONS:
+                        yield os.path.join(dir_path, file_name)
+        else:
+            yield path
+
+def rotateMovie(movie_file, degrees, remux):
+    """ Set the rotation of the movie, in place if possible. Returns a
+        (status, error message) tuple, where status is one of "patched",
+        "remuxed" or "failed". """
+
+    if not remux:
+        try:
+            patchRotation(movie_file, degrees)
+            return "patched", None
+        except (RotationException, OSError, ValueError, struct.error):
+            # ValueError is raised for empty files that can't be mapped
+            pass
+
+    try:
+        remuxRotation(movie_file, degrees)
+    except (RotationException, OSError) as e:
+        return "failed", "Couldn't rotate '%s': %s" % (movie_file, e)
+    return "remuxed", None
+
+if __name__ == "__main__":
+    # Build a parser and parse the command line
+    parser = argparse.ArgumentParser(description = "Set the rotation flag of movie files. The actual content is not changed.")
+    parser.add_argument("-r", "--remux", action = "store_true",
+                        help = "Always remux the files with FFmpeg instead of changing the flag in place.")
+    parser.add_argument("-j", "--jobs", type = int, default = os.cpu_count() or 1,
+                        help = "The number of movies to process at the same time (defaults to the number of processors).")
+    parser.add_argument("degrees", type = int, choices = [0, 90, 180, 270],
+                        help = "The rotation in degrees")
+    parser.add_argument("movie_file", type = str, nargs = "+",
+                        help = "The movie files to rotate, or directories to search (recursively) for movies")
+    args = parser.parse_args()
+
+    if args.jobs < 1:
+        parser.error("The number of jobs should be at least 1")
+
+    counts = collections.Counter()
+    with concurrent.futures.ThreadPoolExecutor(max_workers = args.jobs) as executor:
+        # Keep a bounded number of movies in flight, and report in order
+        in_flight = collections.deque()
+
+        def report():
+            movie_file, future = in_flight.popleft()
+            status, message = future.result()
+            counts[status] += 1
+            if status == "failed":
+                print(message)
+            else:
+                print("Set the rotation of '%s' to %d degrees" % (movie_file, args.degrees))
+
+        for movie_file in findMovies(args.movie_file):
+            in_flight.append((movie_file, executor.submit(rotateMovie, movie_file, args.degrees, args.remux)))
+            while len(in_flight) > 4 * args.jobs:
+                report()
+        while in_flight:
+            report()
+
+    if sum(counts.values()) > 1:
+        print("Processed %d files: %d changed in place, %d remuxed, %d failed" %
+              (sum(counts.values()), counts["patched"], counts["remuxed"], counts["failed"]))
+
+    if counts["failed"]:
+        sys.exit(1)
@@ -2,6 +2,7 @@
 
 # Defaults
 SHAKINESS=5
+ACCURACY=15
 SMOOTHING=10
 OPTZOOM=1
 GENERATETRF=0
@@ -10,6 +11,11 @@ EMITSCRIPT=0
 SCRIPTFILE=""
 FROM=""
 TO=""
+JOBS=1
+SEGMENTS=1
+CROP=""
+THREADS=$(nproc 2>/dev/null || echo 1)
+TRFCACHE="${XDG_CACHE_HOME:-$HOME/.cache}/photoandvideoscripts/trf"
 
 function show_help() {
   echo "USAGE: $0 [options] FILE1 [FILE2 FILE3]"
@@ -18,9 +24,7 @@ Where options are:"
   echo "-s, --shakiness=SHAKINESS 
              The shakiness or quickness of the camera in the input video. This
              parameter corresponds to the \"shakiness\" parameter of the
-             vidstabdetect filter. If you run this script a second time with a
-             modified shakiness parameter, you need to delete the .trf file 
-             first."
+             vidstabdetect filter."
   echo "-a, --averaging=AVERAGING
              The number of frames to average over during the output pass. It
              corresponds to the \"smoothing\" parameter of the vidstabtransform
@@ -34,7 +38,10 @@ Where options are:"
              Deinterlace the video before stabilizing it. The shakiness
              detection doesn't work very well on interlaced videos."
   echo "--overwrite-trf
-             Overwrite previously generated .trf file."
+             Overwrite previously generated .trf file. The .trf files are
+             cached in $TRFCACHE, by the contents of the input file and the
+             shakiness, range and deinterlace options, so normally they're
+             only reused when they still apply."
   echo "--script
              Write out a bash script to reproduce the steps to transform the
              input video file to the output video file. It has the same file  
@@ -44,6 +51,19 @@ Where options are:"
   echo "--from=TIMESTAMP
 --to=TIMESTAMP
              Process only the specified part of the video."
+  echo "-j, --jobs=JOBS
+             The number of files to process at the same time. The output of
+             each file is shown when it's done, in the order of the files."
+  echo "-t, --threads=THREADS
+             The total number of threads FFmpeg may use, divided over the
+             jobs. This also limits the filter threads and the OpenMP threads
+             of vid.stab. Defaults to the number of processors."
+  echo "--segments=SEGMENTS
+             Split the output pass of each file into SEGMENTS parts that are
+             encoded at the same time, and join them afterwards. This speeds up
+             long videos on machines with many processors. It can't be
+             combined with --from and --to, and needs optzoom 0. The borders
+             are black instead of filled from the previous frame."
   echo "-h, --help
              Print out this help and exit."
   exit 1
@@ -55,14 +75,224 @@ function execute() {
   
   # Run the command
   $1
+  local STATUS=$?
   
   # Write it to the script, if needed
+  emit "$1"
+
+  return $STATUS
+}
+
+function execute_background() {
+  # Like execute, but run the command in the background. The caller can find
+  # its PID in $!.
+  emit "$1 &"
+  $1 &
+}
+
+function emit() {
+  # Append a line to the script, if we need to emit one.
   if [[ ! -z $SCRIPTFILE ]]; then
     echo $1 >> $SCRIPTFILE
   fi
 }
 
-if ! OPTIONS=$(getopt -u -o s:a:o:h -l shakiness:,averaging:,optzoom:,deinterlace,overwrite-trf,script,from:,top: -- "$@")
+function trf_path() {
+  # Print the path of the cached .trf file for the given input file. The key is
+  # a hash of the size, modification time and first and last MB of the file,
+  # together with all options that influence the detect pass.
+  local KEY
+  KEY=$( { stat -L -c '%s %Y' "$1"
+           head -c 1048576 "$1"
+           tail -c 1048576 "$1"
+           echo "shakiness=${SHAKINESS} accuracy=${ACCURACY} from=${FROM} to=${TO} deinterlace=${DEINTERLACE}"
+         } | sha1sum | cut -d ' ' -f 1 )
+  echo "${TRFCACHE}/${KEY}.trf"
+}
+
+function transform_segments() {
+  # Run the output pass for FILE in SEGMENTS parts at the same time, and join
+  # them. The parts start at keyframes. Each part is decoded from an earlier
+  # keyframe and gets its own slice of the .trf file that extends beyond both
+  # ends, so vidstabtransform sees the full smoothing window. That is all the
+  # history a frame depends on only without zoom (optzoom 0) and with black
+  # borders (crop=black); the dynamic zoom and the default crop=keep, which
+  # fills the borders from the previous output frame, reach back further.
+  # Returns 2 if the video can't be split, so the caller can fall back to a
+  # single pass.
+  local FILE="$1"
+  local BASE="$2"
+  local TRF="$3"
+  local PREFILTER="$4"
+  local OVERLAP=$(( SMOOTHING * 2 + 1 ))
+  local START_TIME PACKETS FRAMES LINE I J K
+
+  # The index (in presentation order) and time of all keyframes
+  START_TIME=$(ffprobe -v error -show_entries format=start_time -of csv=p=0 "$FILE")
+  if [[ ! $START_TIME =~ ^-?[0-9.]+$ ]]; then
+    START_TIME=0
+  fi
+  PACKETS=$(ffprobe -v error -select_streams v:0 -show_entries packet=pts_time,flags -of csv=p=0 "$FILE" | grep -v '^N/A' | sort -t, -k1,1g)
+  FRAMES=$(echo "$PACKETS" | grep -c .)
+  local KEY_INDEX=() KEY_TIME=()
+  while read -r LINE; do
+    KEY_INDEX+=(${LINE% *})
+    KEY_TIME+=(${LINE#* })
+  done < <(echo "$PACKETS" | awk -F, '$2 ~ /K/ { print NR - 1, $1 }')
+
+  if [ ${#KEY_INDEX[@]} -eq 0 ] || [ $FRAMES -ne $(grep -c '^Frame ' "$TRF") ]; then
+    echo "- can't match the frames of the video to the stabilization file, not splitting"
+    return 2
+  fi
+
+  # The first keyframe at or after each equal share of the frames marks the
+  # start of a part
+  local BOUNDS=(0)
+  for (( I = 1; I < SEGMENTS; I++ )); do
+    for K in "${KEY_INDEX[@]}"; do
+      if [ $K -ge $(( FRAMES * I / SEGMENTS )) ]; then
+        if [ $K -gt ${BOUNDS[-1]} ]; then
+          BOUNDS+=($K)
+        fi
+        break
+      fi
+    done
+  done
+  BOUNDS+=($FRAMES)
+
+  local PARTS=$(( ${#BOUNDS[@]} - 1 ))
+  local PARTTHREADS=$(( FFTHREADS / PARTS ))
+  if [ $PARTTHREADS -lt 1 ]; then
+    PARTTHREADS=1
+  fi
+  echo "- creating new video file in $PARTS parts"
+  local -x OMP_NUM_THREADS=$PARTTHREADS
+  emit "export OMP_NUM_THREADS=${PARTTHREADS}"
+
+  local LIST="${BASE}_vidstab.parts.txt"
+  local PART_FILES=() SLICES=() PIDS=()
+  local FAILED=0
+  for (( I = 0; I < PARTS; I++ )); do
+    local FIRST=${BOUNDS[$I]}
+    local END=${BOUNDS[$((I + 1))]}
+
+    # Decode from the last keyframe that leaves enough frames before the part
+    # to fill the smoothing window
+    J=0
+    for K in "${!KEY_INDEX[@]}"; do
+      if [ ${KEY_INDEX[$K]} -le $(( FIRST - OVERLAP )) ]; then
+        J=$K
+      fi
+    done
+    local DECODE=${KEY_INDEX[$J]}
+    local SEEK=""
+    if [ $DECODE -gt 0 ]; then
+      SEEK="-ss $(awk -v t=${KEY_TIME[$J]} -v s=$START_TIME 'BEGIN { printf "%.6f", t - s - 0.001 }') "
+    fi
+
+    # Frame N of the .trf file describes frame N - 1 of the video. The slice is
+    # written next to the part, and removed with it.
+    local LAST=$(( END + OVERLAP < FRAMES ? END + OVERLAP : FRAMES ))
+    local SLICE="${BASE}_vidstab.part${I}.trf"
+    local SLICER='/^Frame / { n = $2 + 0; if (n < first || n > last) next; sub(/^Frame [0-9]+/, "Frame " (n - first + 1)) } { print }'
+    SLICES+=("$SLICE")
+    awk -v first=$((DECODE + 1)) -v last=$LAST "$SLICER" "$TRF" > "$SLICE"
+    if [ $? != 0 ]; then
+      FAILED=1
+      break
+    fi
+    emit "awk -v first=$((DECODE + 1)) -v last=$LAST '$SLICER' ${TRF} > ${SLICE}"
+
+    local PART="${BASE}_vidstab.part${I}.mp4"
+    PART_FILES+=("$PART")
+    execute_background "ffmpeg -nostdin -y -loglevel 8 -threads ${PARTTHREADS} -filter_threads ${PARTTHREADS} ${SEEK}-i ${FILE} -an -vf ${PREFILTER}vidstabtransform=input=${SLICE}:optzoom=$OPTZOOM:crop=black:interpol=3:smoothing=${SMOOTHING},trim=start_frame=$(( FIRST - DECODE )):end_frame=$(( END - DECODE )),setpts=PTS-STARTPTS -threads ${PARTTHREADS} ${PART}"
+    PIDS+=($!)
+  done
+  emit "wait"
+  emit "export OMP_NUM_THREADS=${FFTHREADS}"
+
+  for K in "${PIDS[@]}"; do
+    wait $K || FAILED=1
+  done
+
+  # Join the parts without re-encoding them, and take the audio from the
+  # original video
+  printf "file '%s'\n" "${PART_FILES[@]##*/}" > "$LIST"
+  emit "printf \"file '%s'\\n\" ${PART_FILES[*]##*/} > ${LIST}"
+  if [ $FAILED == 0 ]; then
+    execute "ffmpeg -loglevel 8 -f concat -safe 0 -i ${LIST} -i ${FILE} -map 0:v -map 1:a? -c:v copy ${THREADOPTS}${BASE}_vidstab.mp4" || FAILED=1
+  fi
+  execute "rm -f ${LIST} ${PART_FILES[*]} ${SLICES[*]}"
+
+  return $FAILED
+}
+
+function process_file() {
+  # Stabilize a single file
+  local FILE="$1"
+  local BASE="${FILE%.*}"
+  local EXT="${FILE##*.}"
+  local GENERATE=$GENERATETRF
+  local PREFILTER=""
+  local TRF
+
+  if [[ $BASE == *"_vidstab" ]]; then
+    echo "$FILE is already stabilized, skipping"
+    return 0
+  fi
+  
+  echo "###### Processing $BASE.$EXT ######"
+
+  if [ $EMITSCRIPT == 1 ]; then
+    SCRIPTFILE="${BASE}.sh"
+    echo "#!/bin/bash" > $SCRIPTFILE
+    chmod 755 $SCRIPTFILE
+    emit "export OMP_NUM_THREADS=${OMP_NUM_THREADS}"
+  fi
+  
+  # Deinterlace in the filter chain of both passes, rather than writing a
+  # (huge) lossless deinterlaced copy first
+  if [ $DEINTERLACE == 1 ]; then
+    PREFILTER="yadif,"
+  fi
+
+  TRF=$(trf_path "$FILE") || return 1
+  if [ ! -e "$TRF" ]; then
+    GENERATE=1
+  fi
+  
+  if [ $GENERATE == 1 ]; then
+    echo "- creating stabilization file"
+    mkdir -p "$TRFCACHE"
+    # Write to a temporary name first, so an interrupted run doesn't leave an
+    # incomplete .trf file in the cache
+    execute "ffmpeg -loglevel 8 ${THREADOPTS}${FROM}-i ${FILE} ${TO}-vf ${PREFILTER}vidstabdetect=result=${TRF}.part:accuracy=${ACCURACY}:shakiness=${SHAKINESS} -f null -" || return 1
+    execute "mv ${TRF}.part ${TRF}" || return 1
+  else
+    echo "- using existing stabilization file"
+  fi
+
+  local STATUS=2
+  if [ $SEGMENTS -gt 1 ]; then
+    transform_segments "$FILE" "$BASE" "$TRF" "$PREFILTER"
+    STATUS=$?
+    if [ $STATUS == 1 ]; then
+      return 1
+    fi
+  fi
+  if [ $STATUS == 2 ]; then
+    echo "- creating new video file"
+    execute "ffmpeg -loglevel 8 ${THREADOPTS}${FROM}-i ${FILE} ${TO}-vf ${PREFILTER}vidstabtransform=input=${TRF}:optzoom=$OPTZOOM${CROP}:interpol=3:smoothing=${SMOOTHING} ${THREADOPTS}${BASE}_vidstab.mp4" || return 1
+  fi
+  
+  echo "- copying metadata"
+  execute "exiftool -q -tagsfromfile ${FILE} ${BASE}_vidstab.mp4"
+  execute "rm ${BASE}_vidstab.mp4_original"
+  
+  echo "- Done! The new file is called ${BASE}_vidstab.mp4"
+}
+
+if ! OPTIONS=$(getopt -u -o s:a:o:j:t:h -l shakiness:,averaging:,optzoom:,deinterlace,overwrite-trf,script,from:,top:,jobs:,threads:,segments: -- "$@")
 then
   exit 1
 fi
@@ -80,6 +310,9 @@ do
     --script)        EMITSCRIPT=1;;
     --from)          FROM="-ss $2 "; shift;;
     --top)           TO="-to $2 ";    shift;;
+    -j|--jobs)       JOBS="$2";      shift ;;
+    -t|--threads)    THREADS="$2";   shift ;;
+    --segments)      SEGMENTS="$2";  shift ;;
     -h| --help)      show_help;;
     (--) shift; break;;
     (*) break;;
@@ -92,56 +325,88 @@ if [ "$#" -eq 0 ]; then
   show_help
 fi
 
-# Process all FILEs
-for FILE in "$@"; do
-  BASE="${FILE%.*}"
-  EXT="${FILE##*.}"
+# The numbers of jobs, threads and segments are used in divisions
+for OPTION in "--jobs=$JOBS" "--threads=$THREADS" "--segments=$SEGMENTS"; do
+  if [[ ! ${OPTION#*=} =~ ^[1-9][0-9]*$ ]]; then
+    echo "${OPTION%%=*} should be a positive number, not '${OPTION#*=}'"
+    exit 1
+  fi
+done
 
-  if [[ $BASE == *"_vidstab" ]]; then
-    echo "$FILE is already stabilized, skipping"
-    BASE=""
+if [ $SEGMENTS -gt 1 ]; then
+  if [[ ! -z $FROM || ! -z $TO ]]; then
+    echo "--segments can't be combined with --from and --to"
+    exit 1
+  fi
+  # The static zoom is determined from the whole video, and the dynamic zoom
+  # changes gradually over more frames than the parts overlap, so each part
+  # would get a different zoom
+  if [ $OPTZOOM != 0 ]; then
+    echo "--segments needs optzoom 0, the zoom can't be split"
+    exit 1
   fi
-  
-  if [ "$BASE" != "" ]; then
-    echo "###### Processing $BASE.$EXT ######"
 
-    if [ $EMITSCRIPT == 1 ]; then
-      SCRIPTFILE="${BASE}.sh"
-      echo "#!/bin/bash" > $SCRIPTFILE
-      chmod 755 $SCRIPTFILE
-    fi
-    
-    if [ $DEINTERLACE == 1 ]; then
-      echo "- creating deinterlaced copy"
-      WORKING_FILE="$BASE"_deint.mp4
-      execute "ffmpeg -loglevel 8 ${FROM}-i ${FILE} ${TO}-vf yadif -c:v libx264 -crf 0 -acodec copy ${WORKING_FILE}"
-    else
-      WORKING_FILE="$FILE"
-    fi
+  # Black borders, also when falling back to a single pass, so all files look
+  # the same
+  CROP=":crop=black"
+fi
 
-    if [ ! -e "$FILE".trf ]; then
-      GENERATETRF=1
-    fi
-    
-    if [ $GENERATETRF == 1 ]; then
-      echo "- creating stabilization file"
-      execute "ffmpeg -loglevel 8 ${FROM}-i ${WORKING_FILE} ${TO}-vf vidstabdetect=result=${FILE}.trf:accuracy=15:shakiness=${SHAKINESS} -f null -"
-    else
-      echo "- using existing stabilization file"
-    fi
- 
-    echo "- creating new video file"
-    execute "ffmpeg -loglevel 8 ${FROM}-i ${WORKING_FILE} ${TO}-vf vidstabtransform=input=${FILE}.trf:optzoom=$OPTZOOM:interpol=3:smoothing=${SMOOTHING} ${BASE}_vidstab.mp4"
-    
-    echo "- copying metadata"
-    execute "exiftool -q -tagsfromfile ${FILE} ${BASE}_vidstab.mp4"
-    execute "rm ${BASE}_vidstab.mp4_original"
-    
-    if [ $DEINTERLACE == 1 ]; then
-      echo "- removing deinterlaced copy"
-      execute "rm ${WORKING_FILE}"
-    fi
-    
-    echo "- Done! The new file is called ${BASE}_vidstab.mp4"
-  fi
-done
+# Divide the threads over the jobs
+FFTHREADS=$(( THREADS / JOBS ))
+if [ $FFTHREADS -lt 1 ]; then
+  FFTHREADS=1
+fi
+# Limit the filter threads and the OpenMP threads of vid.stab as well
+THREADOPTS="-threads ${FFTHREADS} -filter_threads ${FFTHREADS} "
+export OMP_NUM_THREADS=$FFTHREADS
+
+# Process all FILEs
+FAILED=0
+if [ $JOBS -le 1 ]; then
+  for FILE in "$@"; do
+    process_file "$FILE" || FAILED=$((FAILED + 1))
+  done
+else
+  # Run up to JOBS files in the background at the same time, so the detect
+  # pass of one file can run alongside the transform pass of another. The
+  # output of each file is collected in a log file and shown in order, as
+  # soon as the file and all files before it are done.
+  LOGDIR=$(mktemp -d)
+  PIDS=()
+  SHOWN=0
+
+  # Show the logs of the finished files that are next in line. With "all",
+  # wait for the remaining files as well.
+  function show_logs() {
+    while [ $SHOWN -lt ${#PIDS[@]} ]; do
+      if [ "$1" != "all" ] && jobs -rp | grep -qx "${PIDS[$SHOWN]}"; then
+        break
+      fi
+      wait ${PIDS[$SHOWN]}
+      STATUS=$?
+      cat "$LOGDIR/$SHOWN.log"
+      if [ $STATUS -ne 0 ]; then
+        echo "- FAILED"
+        FAILED=$((FAILED + 1))
+      fi
+      SHOWN=$((SHOWN + 1))
+    done
+  }
+
+  for FILE in "$@"; do
+    while [ $(jobs -rp | wc -l) -ge $JOBS ]; do
+      wait -n
+    done
+    show_logs
+    process_file "$FILE" > "$LOGDIR/${#PIDS[@]}.log" 2>&1 &
+    PIDS+=($!)
+  done
+  show_logs all
+  rm -r "$LOGDIR"
+
+  echo "###### Processed ${#PIDS[@]} files, $FAILED failed ######"
+fi
+
+if [ $FAILED -gt 0 ]; then
+  exit 1
+fi
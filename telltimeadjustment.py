@@ -1,45 +1,73 @@
 #!/usr/bin/env python3
 
-import datetime, sys, subprocess, os.path, re, time
+import datetime, sys, os.path, re, sqlite3, time
+
+from correctphotodrift import MetaDataCache, readMetaDataBatch
 
 RE_TIME = re.compile("([0-9]{1,2}):([0-9]{1,2}):([0-9]{1,2})")
 
 if __name__ == "__main__":
-  photo_file    = None
-  time_on_photo = None
-  
-  if len(sys.argv) == 3:
-    if os.path.exists(sys.argv[1]) and os.path.isfile(sys.argv[1]):
-      photo_file = sys.argv[1]
-    
-    match = RE_TIME.match(sys.argv[2])
-    if match:
+  # The arguments are pairs of a photo and the time on it
+  pairs = []
+  arguments = sys.argv[1:]
+  use_cache = "--no-cache" not in arguments
+  arguments = [argument for argument in arguments if argument != "--no-cache"]
+  if len(arguments) >= 2 and len(arguments) % 2 == 0:
+    for photo_file, time_string in zip(arguments[::2], arguments[1::2]):
+      match = RE_TIME.match(time_string)
+      if not (os.path.exists(photo_file) and os.path.isfile(photo_file) and match):
+        pairs = []
+        break
       time_on_photo = time.mktime((0, 0, 0, int(match.group(1)), int(match.group(2)), int(match.group(3)), 0, 0, -1))
+      pairs.append((photo_file, time_on_photo))
   
   # Parse time the user has give
-  if not (photo_file and time_on_photo):
+  if not pairs:
     print("Tell the time adjustment that needs to be made on this photo")
-    print("Usage: %s IMAGE_FILE HH:MM:SS" % sys.argv[0])
+    print("Usage: %s [--no-cache] IMAGE_FILE HH:MM:SS [IMAGE_FILE HH:MM:SS ...]" % sys.argv[0])
     sys.exit(1)
 
-  # Figure out the EXIF datetime
-  result = subprocess.run(["exiftool", "-CreateDate", "-S", "-dateFormat", "%H:%M:%S", photo_file], stdout = subprocess.PIPE)
-  if result.returncode != 0:
+  # Figure out the EXIF datetimes, all in one go. The metadata cache saves us
+  # from running exiftool again for a photo we've seen before.
+  cache = None
+  if use_cache:
+    try:
+      cache = MetaDataCache()
+    except (OSError, sqlite3.Error):
+      cache = None
+  try:
+    metadatas = list(readMetaDataBatch([photo_file for photo_file, _ in pairs], cache = cache))
+  except Exception:
     print("Couldn't run exiftool. Aborting")
     sys.exit(1)
-  match = RE_TIME.search(str(result.stdout))
-  time_exif = time.mktime((0, 0, 0, int(match.group(1)), int(match.group(2)), int(match.group(3)), 0, 0, -1))
+  finally:
+    if cache:
+      cache.close()
+
+  failed = False
+  for (photo_file, time_on_photo), (_, metadata) in zip(pairs, metadatas):
+    # Only mention the photo if there's more than one
+    prefix = "%s: " % photo_file if len(pairs) > 1 else ""
+
+    match = RE_TIME.search(metadata.tag_values.get("CreateDate", "")) if metadata else None
+    if not match:
+      print("%sThe photo doesn't have a CreateDate tag%s" % (prefix, "" if len(pairs) > 1 else ". Aborting"))
+      failed = True
+      continue
+    time_exif = time.mktime((0, 0, 0, int(match.group(1)), int(match.group(2)), int(match.group(3)), 0, 0, -1))
   
-  # Output the difference
-  diff  = int(time_on_photo - time_exif)
-  if diff != 0:
-    sign = diff / abs(diff)   # Determine if we should add or subtract
-    diff = abs(diff)          # Make the number of seconds positive
-    hours = diff / (60 * 60)  # Calculate the hours
-    diff = diff % (60 * 60)   # Determine remaining seconds
-    minutes = diff / 60       # Convert remaining seconds to minutes
-    seconds = diff % 60       # And save the remainder
-    print("To correct the time for this photo, adjust it by %s%02d:%02d:%02d" % ("+" if sign == 1 else "-", hours, minutes, seconds))
-  else:
-    print("Time is already correct")
-  
\ No newline at end of file
+    # Output the difference
+    diff  = int(time_on_photo - time_exif)
+    if diff != 0:
+      sign = diff / abs(diff)   # Determine if we should add or subtract
+      diff = abs(diff)          # Make the number of seconds positive
+      hours = diff / (60 * 60)  # Calculate the hours
+      diff = diff % (60 * 60)   # Determine remaining seconds
+      minutes = diff / 60       # Convert remaining seconds to minutes
+      seconds = diff % 60       # And save the remainder
+      print("%sTo correct the time for this photo, adjust it by %s%02d:%02d:%02d" % (prefix, "+" if sign == 1 else "-", hours, minutes, seconds))
+    else:
+      print("%sTime is already correct" % prefix)
+
+  if failed:
+    sys.exit(1)